@@ -0,0 +1,221 @@
+"""Local stand-ins for the Plex Discover, plex.tv, Plex server and TMDB APIs.
+
+A single HTTP server answers every route the sync uses, from a deterministic
+dataset of ``watchlist`` items and ``library`` server items:
+
+- ``/library/sections/watchlist/all``: discover watchlist, JSON, paginated.
+- ``/api/resources``: plex.tv resources XML with one unreachable connection
+  followed by the working one.
+- ``/library/sections`` and ``/library/sections/<key>/all``: server sections
+  as XML, honouring ``X-Plex-Container-Start/Size`` and ``updatedAt>>=``.
+- ``/library/metadata/<key>/thumb/<n>``: poster images (a 1x1 GIF).
+- ``/3/search/<movie|tv>``: TMDB search.
+- ``/3/<movie|tv>/<id>`` and ``/3/find/<imdb id>``: TMDB lookups by id.
+- ``/__stats``: request counters by route (``?reset=1`` clears them).
+
+About two thirds of the watchlist is on the server: half of those match by
+GUID and the other half only by title and year. Half of the watchlist
+carries TMDB and IMDb ids, a quarter only the IMDb id and a quarter none
+(TMDB has to search those by title).
+"""
+import json
+import time
+import base64
+import functools
+import threading
+import urllib.parse
+from collections import Counter
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from xml.sax.saxutils import quoteattr
+
+SERVER_NAME = "BenchServer"
+ACCESS_TOKEN = "bench-access-token"
+MOVIES_KEY = "1"
+SHOWS_KEY = "2"
+BASE_TIME = 1_700_000_000
+POSTER = base64.b64decode("R0lGODlhAQABAIAAAP///wAAACH5BAEAAAAALAAAAAABAAEAAAICRAEAOw==")
+
+
+class Dataset:
+    def __init__(self, watchlist_size, library_size):
+        self.watchlist_size = watchlist_size
+        self.library_size = library_size
+
+    @staticmethod
+    def rating_key(i):
+        return f"{i:024x}"
+
+    def server_item(self, i):
+        is_show = i % 4 == 3
+        return {
+            "ratingKey": str(100000 + i),
+            "title": f"Título {i}",
+            "originalTitle": f"Title {i}" if i % 2 else "",
+            "year": 1950 + i % 75,
+            "guid": f"plex://{'show' if is_show else 'movie'}/{self.rating_key(i)}",
+            "addedAt": BASE_TIME + i,
+            "updatedAt": BASE_TIME + i,
+            "section": SHOWS_KEY if is_show else MOVIES_KEY,
+        }
+
+    def watchlist_item(self, j):
+        stride = max(1, self.library_size // max(1, self.watchlist_size))
+        i = j * stride
+        kind = j % 3
+        if kind == 2 or i >= self.library_size:
+            # No está en el servidor
+            i = self.library_size + j
+            key = self.rating_key(10 ** 9 + j)
+        elif kind == 1:
+            # Solo coincide por título y año
+            key = self.rating_key(10 ** 8 + j)
+        else:
+            key = self.rating_key(i)
+        base = self.server_item(i)
+        guids = [{"id": f"tmdb://{500000 + j}"}, {"id": f"imdb://tt{7000000 + j}"}]
+        if j % 4 == 2:
+            guids = guids[1:]  # Solo IMDb
+        elif j % 4 == 3:
+            guids = []
+        return {
+            "ratingKey": key,
+            "guid": f"plex://movie/{key}",
+            "title": base["title"],
+            "originalTitle": base["originalTitle"] or None,
+            "year": base["year"],
+            "type": "show" if base["section"] == SHOWS_KEY else "movie",
+            "thumb": f"/library/metadata/{key}/thumb/1",
+            "Guid": guids,
+        }
+
+    @functools.lru_cache(maxsize=16)
+    def section_items(self, key, since=0):
+        """Server item indexes in section ``key`` updated at or after ``since``."""
+        return [
+            i for i in range(self.library_size)
+            if (SHOWS_KEY if i % 4 == 3 else MOVIES_KEY) == key and BASE_TIME + i >= since
+        ]
+
+
+def make_handler(dataset, latency, stats, lock):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def _send(self, body, content_type):
+            data = body if isinstance(body, bytes) else body.encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def _count(self, route):
+            with lock:
+                stats[route] += 1
+
+        def do_GET(self):
+            parsed = urllib.parse.urlparse(self.path)
+            query = {k: v[-1] for k, v in urllib.parse.parse_qs(parsed.query).items()}
+            path = parsed.path
+            if path == "/__stats":
+                with lock:
+                    body = json.dumps(dict(stats))
+                    if query.get("reset"):
+                        stats.clear()
+                return self._send(body, "application/json")
+
+            if latency:
+                time.sleep(latency)
+            start = int(query.get("X-Plex-Container-Start", 0))
+            size = int(query.get("X-Plex-Container-Size", 100))
+
+            if path == "/library/sections/watchlist/all":
+                self._count("watchlist")
+                end = min(dataset.watchlist_size, start + size)
+                items = [dataset.watchlist_item(j) for j in range(start, end)]
+                return self._send(json.dumps({"MediaContainer": {
+                    "totalSize": dataset.watchlist_size, "size": len(items), "Metadata": items
+                }}), "application/json")
+
+            if path == "/api/resources":
+                self._count("resources")
+                host = self.headers.get("Host")
+                return self._send(
+                    f'<MediaContainer><Device name="{SERVER_NAME}" clientIdentifier="bench-server" provides="server" accessToken="{ACCESS_TOKEN}">'
+                    f'<Connection uri="http://127.0.0.1:9" local="1"/>'
+                    f'<Connection uri="http://{host}" local="0"/>'
+                    f'</Device></MediaContainer>', "application/xml")
+
+            if path == "/library/sections":
+                self._count("sections")
+                return self._send(
+                    f'<MediaContainer><Directory key="{MOVIES_KEY}" title="Películas" type="movie"/>'
+                    f'<Directory key="{SHOWS_KEY}" title="Series" type="show"/></MediaContainer>', "application/xml")
+
+            if path.startswith("/library/sections/") and path.endswith("/all"):
+                self._count("library_items")
+                key = path.split("/")[3]
+                since = int(query.get("updatedAt>>", 0) or 0)
+                ids = dataset.section_items(key, since)
+                page = ids[start:start + size]
+                tag = "Directory" if key == SHOWS_KEY else "Video"
+                parts = [f'<MediaContainer size="{len(page)}" totalSize="{len(ids)}">']
+                for i in page:
+                    item = dataset.server_item(i)
+                    attrs = " ".join(f"{k}={quoteattr(str(v))}" for k, v in item.items() if k != "section")
+                    parts.append(f'<{tag} {attrs} summary="Resumen de prueba"><Genre tag="Drama"/></{tag}>')
+                parts.append("</MediaContainer>")
+                return self._send("".join(parts), "application/xml")
+
+            if path.startswith("/library/metadata/") and "/thumb/" in path:
+                self._count("posters")
+                return self._send(POSTER, "image/gif")
+
+            if path.startswith("/3/search/"):
+                self._count("tmdb_search")
+                q = query.get("query", "")
+                digits = "".join(c for c in q if c.isdigit())
+                results = []
+                if digits and int(digits) % 10:
+                    n = int(digits)
+                    results = [{"id": 500000 + n, "vote_average": (n % 90) / 10 + 1}]
+                return self._send(json.dumps({"results": results}), "application/json")
+
+            if path.startswith("/3/find/"):
+                self._count("tmdb_find")
+                j = int(path.rsplit("/tt", 1)[-1] or 0) - 7000000
+                results = {"movie_results": [], "tv_results": []}
+                if 0 <= j < dataset.watchlist_size:
+                    kind = "movie" if dataset.watchlist_item(j)["type"] == "movie" else "tv"
+                    results[f"{kind}_results"] = [{"id": 500000 + j, "vote_average": (j % 90) / 10 + 1}]
+                return self._send(json.dumps(results), "application/json")
+
+            if path.startswith(("/3/movie/", "/3/tv/")):
+                self._count("tmdb_details")
+                j = int(path.rsplit("/", 1)[-1]) - 500000
+                if 0 <= j < dataset.watchlist_size:
+                    return self._send(json.dumps({"id": 500000 + j, "vote_average": (j % 90) / 10 + 1}), "application/json")
+
+            self._count("not_found")
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+    return Handler
+
+
+def serve(watchlist_size, library_size, latency=0.0, port=0, ready=None):
+    """Runs the fake services until the process is killed.
+
+    ``ready`` (a ``multiprocessing`` connection) receives the bound port.
+    """
+    stats = Counter()
+    handler = make_handler(Dataset(watchlist_size, library_size), latency, stats, threading.Lock())
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+    server.daemon_threads = True
+    if ready is not None:
+        ready.send(server.server_address[1])
+    server.serve_forever()
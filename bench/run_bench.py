@@ -0,0 +1,194 @@
+"""Offline benchmark of ``sync_watchlist`` against local fake services.
+
+Runs every scale in a fresh subprocess (so peak RSS is per scale), drives
+the real sync end-to-end a few times (cold, then warm caches/snapshot) and
+reports wall time, peak RSS and the requests each run made to the fakes.
+
+Usage (from the repository root):
+
+    python -m bench.run_bench                       # mongomock, small scale
+    python -m bench.run_bench --mongo-uri mongodb://localhost:27017 --scales 1kx10k 10kx100k --output bench_output.txt
+
+Without ``--mongo-uri`` the sync runs against ``mongomock``, installed with
+the pinned pymongo it works with by ``pip install -r bench/requirements.txt``.
+Its upserts scan the whole collection, so the library stage grows
+quadratically: scales with more than ``MONGOMOCK_MAX_LIBRARY`` library items
+require a local or ephemeral ``mongod`` (``--mongo-uri``), which is also what
+gives representative numbers. A random ``plex_bench_*`` database is used and
+dropped afterwards.
+
+A scale stops at its first sync that does not end in ``success``, and the
+command then exits with status 1.
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import shutil
+import tempfile
+import argparse
+import threading
+import resource
+import subprocess
+import multiprocessing
+import urllib.request
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MONGOMOCK_MAX_LIBRARY = 2000  # 400x2000 tarda ~25 s en frío con mongomock; 1kx10k, más de 10 minutos
+DEFAULT_SCALES = ["1000x10000", "10000x100000"]
+MONGOMOCK_SCALES = ["200x2000"]
+
+
+def parse_scale(text):
+    watchlist, library = text.lower().replace("k", "000").split("x")
+    return int(watchlist), int(library)
+
+
+def fetch_stats(base_url, reset=False):
+    with urllib.request.urlopen(f"{base_url}/__stats{'?reset=1' if reset else ''}") as resp:
+        return json.loads(resp.read())
+
+
+def peak_rss_mb():
+    # ru_maxrss está en KiB en Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run_child(args):
+    """Runs inside the per-scale subprocess and prints one JSON line per sync run."""
+    from bench.fake_services import serve, SERVER_NAME
+
+    watchlist_size, library_size = parse_scale(args.scale)
+    parent_conn, child_conn = multiprocessing.Pipe()
+    fakes = multiprocessing.Process(
+        target=serve,
+        args=(watchlist_size, library_size, args.latency_ms / 1000),
+        kwargs={"ready": child_conn},
+        daemon=True
+    )
+    fakes.start()
+    base_url = f"http://127.0.0.1:{parent_conn.recv()}"
+
+    db_name = f"plex_bench_{uuid.uuid4().hex[:8]}"
+    poster_dir = tempfile.mkdtemp(prefix="plex_bench_posters_")
+    os.environ.update({
+        "PLEX_TOKEN": "bench-token",
+        "SERVER_NAME": SERVER_NAME,
+        "MONGO_URI": args.mongo_uri or "mongodb://localhost",
+        "MONGO_DB": db_name,
+        "TMDB_API_KEY": "bench-key",
+        "TMDB_RATE_LIMIT": str(args.tmdb_rate),
+        "TMDB_REFRESH_PER_RUN": "0",
+        "PLEX_DISCOVER_URL": base_url,
+        "PLEX_TV_URL": base_url,
+        "PLEX_METADATA_URL": base_url,
+        "POSTER_CACHE_DIR": poster_dir,
+        "TMDB_API_URL": f"{base_url}/3",
+        "TELEGRAM_BOT_TOKEN": "",
+        "TELEGRAM_CHAT_ID": "",
+        # Misma máquina que la web: la sincronización precarga los pósters
+        "EMBEDDED_WORKER": "true",
+    })
+    if not args.mongo_uri:
+        import mongomock
+        import pymongo
+        pymongo.MongoClient = mongomock.MongoClient
+
+    import logging
+    sys.path.insert(0, ROOT)
+    import sync
+    logging.getLogger().setLevel(logging.WARNING)
+
+    failed = False
+    try:
+        for run in range(args.runs):
+            fetch_stats(base_url, reset=True)
+            start = time.perf_counter()
+            sync.sync_watchlist(sync.TENANTS[0], f"bench-{run}")
+            wall = time.perf_counter() - start
+            # Trabajo que la sincronización deja en segundo plano (precarga de pósters, avisos)
+            for thread in threading.enumerate():
+                if thread.name in ("poster-prefetch", "telegram-outbox"):
+                    thread.join()
+            last = sync.metrics_store.last_runs(1)
+            status = last[0]["status"] if last else "unknown"
+            print(json.dumps({
+                "scale": args.scale,
+                "run": run,
+                "status": status,
+                "wall_seconds": round(wall, 3),
+                "peak_rss_mb": round(peak_rss_mb(), 1),
+                "requests": fetch_stats(base_url),
+                "stages": {k: round(v, 3) for k, v in (last[0]["stages"] if last else {}).items()},
+                "saved": sync.collection.count_documents({}),
+                "on_server": sync.collection.count_documents({"on_server": True}),
+                "latency_ms": args.latency_ms,
+                "mongo": "uri" if args.mongo_uri else "mongomock",
+            }), flush=True)
+            if status != "success":
+                # Una sincronización fallida no mide nada: se para aquí
+                print(f"{args.scale}: la sincronización {run} terminó con estado {status}", file=sys.stderr)
+                failed = True
+                break
+    finally:
+        if args.mongo_uri:
+            sync.db.client.drop_database(db_name)
+        fakes.terminate()
+        shutil.rmtree(poster_dir, ignore_errors=True)
+    return 1 if failed else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scales", nargs="+",
+                        help=f"WATCHLISTxLIBRARY sizes, e.g. 1kx10k (default {' '.join(DEFAULT_SCALES)} "
+                             f"with --mongo-uri, {' '.join(MONGOMOCK_SCALES)} with mongomock)")
+    parser.add_argument("--runs", type=int, default=2, help="syncs per scale (first cold, rest warm)")
+    parser.add_argument("--latency-ms", type=float, default=20, help="latency added to every fake request")
+    parser.add_argument("--tmdb-rate", type=float, default=500, help="TMDB_RATE_LIMIT for the run")
+    parser.add_argument("--mongo-uri", help="Mongo to use instead of mongomock (a throwaway database is created)")
+    parser.add_argument("--output", help="append the JSON results to this file")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--scale", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        return run_child(args)
+    if not args.scales:
+        args.scales = DEFAULT_SCALES if args.mongo_uri else MONGOMOCK_SCALES
+    if not args.mongo_uri:
+        too_big = [s for s in args.scales if parse_scale(s)[1] > MONGOMOCK_MAX_LIBRARY]
+        if too_big:
+            parser.error(f"{' '.join(too_big)}: con mongomock la librería no puede pasar de "
+                         f"{MONGOMOCK_MAX_LIBRARY} elementos; usa --mongo-uri con un mongod local")
+
+    results = []
+    failed = False
+    for scale in args.scales:
+        cmd = [sys.executable, "-m", "bench.run_bench", "--child", "--scale", scale,
+               "--runs", str(args.runs), "--latency-ms", str(args.latency_ms), "--tmdb-rate", str(args.tmdb_rate)]
+        if args.mongo_uri:
+            cmd += ["--mongo-uri", args.mongo_uri]
+        proc = subprocess.run(cmd, cwd=ROOT, stdout=subprocess.PIPE, text=True)
+        for line in proc.stdout.splitlines():
+            if line.startswith("{"):
+                results.append(json.loads(line))
+        if proc.returncode:
+            print(f"{scale}: el benchmark terminó con código {proc.returncode}", file=sys.stderr)
+            failed = True
+
+    print(f"{'escala':<16}{'run':>4}{'estado':>9}{'tiempo (s)':>12}{'RSS (MB)':>10}  peticiones")
+    for r in results:
+        requests_str = " ".join(f"{k}={v}" for k, v in sorted(r["requests"].items()))
+        print(f"{r['scale']:<16}{r['run']:>4}{r['status']:>9}{r['wall_seconds']:>12}{r['peak_rss_mb']:>10}  {requests_str}")
+
+    if args.output:
+        with open(args.output, "a") as f:
+            for r in results:
+                f.write(json.dumps(dict(r, timestamp=int(time.time()))) + "\n")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
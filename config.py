@@ -0,0 +1,52 @@
+import os
+import tempfile
+from dotenv import load_dotenv
+from constants import DEFAULT_PLEX_DISCOVER_URL, DEFAULT_PLEX_TV_URL, DEFAULT_PLEX_METADATA_URL, DEFAULT_TMDB_API_URL
+from tenants import load_tenants
+
+load_dotenv()
+
+PORT = int(os.getenv("PORT", 5000))
+
+# --- Configuración (común a la web, app.py, y al worker de sincronización, worker.py) ---
+PLEX_TOKEN = os.getenv("PLEX_TOKEN")
+SERVER_NAME = os.getenv("SERVER_NAME", "Navidad")
+MONGO_URI = os.getenv("MONGO_URI") # URI de MongoDB Atlas
+MONGO_DB = os.getenv("MONGO_DB", "plex_manager")
+TMDB_API_KEY = os.getenv("TMDB_API_KEY") # API Key de TMDB
+TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
+TELEGRAM_CHAT_ID = os.getenv("TELEGRAM_CHAT_ID")
+ACCESS_KEY = os.getenv("ACCESS_KEY") # Clave para entrar en la web (?key=); sin TENANTS y sin ella, la web es abierta
+PLEX_POOL_SIZE = int(os.getenv("PLEX_POOL_SIZE", 10)) # Conexiones keep-alive por host
+PLEX_RETRIES = int(os.getenv("PLEX_RETRIES", 3)) # Reintentos ante 5xx/timeouts
+WATCHLIST_FULL_CHECK_HOURS = int(os.getenv("WATCHLIST_FULL_CHECK_HOURS", 6)) # Descarga completa aunque no haya cambios
+SYNC_MIN_INTERVAL_MINUTES = int(os.getenv("SYNC_MIN_INTERVAL_MINUTES", 50)) # Margen entre sincronizaciones programadas
+PLEX_SERVER_CACHE_HOURS = float(os.getenv("PLEX_SERVER_CACHE_HOURS", 12)) # Vigencia de la dirección y secciones del servidor
+LIBRARY_FULL_SYNC_HOURS = int(os.getenv("LIBRARY_FULL_SYNC_HOURS", 24)) # Cada cuánto se relee la librería entera
+TMDB_CACHE_TTL_HOURS = int(os.getenv("TMDB_CACHE_TTL_HOURS", 168)) # Validez de una nota cacheada
+TMDB_NEGATIVE_TTL_HOURS = int(os.getenv("TMDB_NEGATIVE_TTL_HOURS", 24)) # Validez de un "sin resultados"
+TMDB_REFRESH_PER_RUN = int(os.getenv("TMDB_REFRESH_PER_RUN", 25)) # Notas caducadas a renovar por sync
+TMDB_WORKERS = int(os.getenv("TMDB_WORKERS", 8)) # Consultas TMDB simultáneas
+TMDB_RATE_LIMIT = float(os.getenv("TMDB_RATE_LIMIT", 20)) # Peticiones por segundo a TMDB
+FILMAFFINITY_ENABLED = os.getenv("FILMAFFINITY_ENABLED", "false").lower() in ("1", "true", "yes") # Requiere Playwright
+FILMAFFINITY_POOL_SIZE = int(os.getenv("FILMAFFINITY_POOL_SIZE", 3)) # Páginas del navegador en paralelo
+FILMAFFINITY_MAX_PER_RUN = int(os.getenv("FILMAFFINITY_MAX_PER_RUN", 100)) # Títulos consultados por sincronización
+FILMAFFINITY_CACHE_TTL_HOURS = int(os.getenv("FILMAFFINITY_CACHE_TTL_HOURS", 336)) # Vigencia de una nota de FilmAffinity
+POSTER_CACHE_DIR = os.getenv("POSTER_CACHE_DIR", os.path.join(tempfile.gettempdir(), "plex-posters"))
+POSTER_CACHE_MB = int(os.getenv("POSTER_CACHE_MB", 200)) # Tamaño máximo de la caché de pósters en disco
+TELEGRAM_BATCH_SIZE = int(os.getenv("TELEGRAM_BATCH_SIZE", 10)) # Títulos agrupados por mensaje
+TELEGRAM_MESSAGES_PER_MINUTE = float(os.getenv("TELEGRAM_MESSAGES_PER_MINUTE", 20)) # Límite de Telegram por chat
+SYNC_WORKERS = int(os.getenv("SYNC_WORKERS", 2)) # Sincronizaciones de tenants simultáneas por proceso
+LIBRARY_REUSE_SECONDS = int(os.getenv("LIBRARY_REUSE_SECONDS", 300)) # Secciones leídas hace menos no se vuelven a pedir
+WORKER_POLL_SECONDS = int(os.getenv("WORKER_POLL_SECONDS", 10)) # Cada cuánto mira el worker si la web pidió sincronizar
+EMBEDDED_WORKER = os.getenv("EMBEDDED_WORKER", "false").lower() in ("1", "true", "yes") # Worker dentro del proceso web
+
+# Hogares (tenants): cuenta de Plex y servidores de cada uno. Sin TENANTS, uno solo con PLEX_TOKEN y SERVER_NAME
+TENANTS = load_tenants(os.getenv("TENANTS"), PLEX_TOKEN, SERVER_NAME, TELEGRAM_CHAT_ID, ACCESS_KEY)
+TENANTS_BY_ID = {t.id: t for t in TENANTS}
+
+# URLs base de los servicios externos (solo se cambian para apuntar a dobles locales, p. ej. en bench/)
+PLEX_DISCOVER_URL = os.getenv("PLEX_DISCOVER_URL", DEFAULT_PLEX_DISCOVER_URL)
+PLEX_TV_URL = os.getenv("PLEX_TV_URL", DEFAULT_PLEX_TV_URL)
+PLEX_METADATA_URL = os.getenv("PLEX_METADATA_URL", DEFAULT_PLEX_METADATA_URL)
+TMDB_API_URL = os.getenv("TMDB_API_URL", DEFAULT_TMDB_API_URL)
@@ -0,0 +1,15 @@
+"""Constants shared by the web and the sync worker.
+
+They live apart from the clients that use them (``plex_api``, ``tmdb``,
+``posters``) so that ``config`` and ``metrics`` can read them without the
+web process importing the Plex and TMDB clients.
+"""
+
+# URLs base por defecto de los servicios externos (config.py permite cambiarlas)
+DEFAULT_PLEX_DISCOVER_URL = "https://discover.provider.plex.tv"
+DEFAULT_PLEX_TV_URL = "https://plex.tv"
+DEFAULT_PLEX_METADATA_URL = "https://metadata.provider.plex.tv"
+DEFAULT_TMDB_API_URL = "https://api.themoviedb.org/3"
+
+# Límites superiores (segundos) de los buckets del histograma de latencias de Plex
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, float("inf"))
@@ -0,0 +1,19 @@
+import threading
+from pymongo import MongoClient
+from config import MONGO_URI, MONGO_DB
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_db():
+    """The deployment database. The client is created on first use, not at import.
+
+    So importing the web app opens no connection (and gunicorn workers never
+    inherit a client created before the fork).
+    """
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = MongoClient(MONGO_URI)
+    return _client[MONGO_DB]
@@ -1,5 +1,37 @@
+import time
+import asyncio
+import logging
 import urllib.parse
-from playwright.sync_api import sync_playwright
+from datetime import datetime, timezone
+from pymongo import ASCENDING
+
+try:
+    from playwright.sync_api import sync_playwright
+    from playwright.async_api import async_playwright
+except ImportError:  # Opcional: sin Playwright no hay notas de FilmAffinity
+    sync_playwright = async_playwright = None
+
+logger = logging.getLogger(__name__)
+
+FA_URL = "https://www.filmaffinity.com"
+USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/121.0.0.0 Safari/537.36"
+EXTRA_HEADERS = {"Accept-Language": "es-ES,es;q=0.9,en;q=0.8"}
+# Solo hace falta el HTML: la nota y los resultados vienen renderizados en el servidor
+ALLOWED_RESOURCES = {"document"}
+
+
+def search_url(title):
+    return f"{FA_URL}/es/search.php?stext={urllib.parse.quote(title)}"
+
+
+def parse_score(text):
+    """``"7,1"`` -> ``7.1``; anything that is not a score -> ``None``."""
+    text = (text or "").strip().replace(",", ".")
+    try:
+        return float(text)
+    except ValueError:
+        return None
+
 
 class FAScraper:
     def __init__(self):
@@ -14,12 +46,12 @@ class FAScraper:
         # Using a newer Chromium version and setting a realistic viewport
         self._browser = self._playwright.chromium.launch(headless=True)
         self._context = self._browser.new_context(
-            user_agent="Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/121.0.0.0 Safari/537.36",
+            user_agent=USER_AGENT,
             viewport={"width": 1280, "height": 720}
         )
         self._page = self._context.new_page()
         # Add a realistic header
-        self._page.set_extra_http_headers({"Accept-Language": "es-ES,es;q=0.9,en;q=0.8"})
+        self._page.set_extra_http_headers(EXTRA_HEADERS)
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
@@ -34,15 +66,14 @@ class FAScraper:
             return "N/A", "N/A"
 
         try:
-            search_url = f"https://www.filmaffinity.com/es/search.php?stext={urllib.parse.quote(title)}"
-            self._page.goto(search_url, wait_until="domcontentloaded", timeout=20000)
-            
+            self._page.goto(search_url(title), wait_until="domcontentloaded", timeout=20000)
+
             # 1. Direct hit?
             rating_div = self._page.query_selector("#movie-rat-avg")
             if rating_div:
                 score = rating_div.inner_text().strip().replace(",", ".")
                 return score, self._page.url
-            
+
             # 2. Search results?
             if "search.php" in self._page.url:
                 results = self._page.query_selector_all(".se-it")
@@ -52,22 +83,249 @@ class FAScraper:
                         href = link.get_attribute("href")
                         if href and "/film" in href:
                             if not href.startswith("http"):
-                                href = "https://www.filmaffinity.com" + href
-                            
-                            # We found the link! 
+                                href = FA_URL + href
+
+                            # We found the link!
                             # We can try to get the rating if it's visible in the search item
                             rating_in_result = results[0].query_selector(".avgrat-box") or \
                                                results[0].query_selector(".rat-avg")
-                            
+
                             score = "N/A"
                             if rating_in_result:
                                 txt = rating_in_result.inner_text().strip().replace(",", ".")
                                 if txt and txt[0].isdigit():
                                     score = txt
-                            
+
                             return score, href
-            
+
         except Exception:
             pass
-            
-        return "N/A", f"https://www.filmaffinity.com/es/search.php?stext={urllib.parse.quote(title)}"
+
+        return "N/A", search_url(title)
+
+
+class FAPagePool:
+    """One headless Chromium with ``size`` warm contexts that look titles up concurrently.
+
+    Each context keeps a single page that is reused for every title, and
+    all requests except the HTML document itself (images, CSS, fonts,
+    scripts...) are aborted. Playwright's sync API cannot share a browser
+    between threads, so the pool drives the async API on its own event loop:
+    ``lookup_many`` is a blocking call.
+    """
+
+    def __init__(self, size=3, timeout=20000):
+        self.size = size
+        self.timeout = timeout
+
+    @staticmethod
+    async def _block_resources(route):
+        if route.request.resource_type in ALLOWED_RESOURCES:
+            await route.continue_()
+        else:
+            await route.abort()
+
+    async def _new_page(self, browser):
+        context = await browser.new_context(user_agent=USER_AGENT, viewport={"width": 1280, "height": 720})
+        await context.set_extra_http_headers(EXTRA_HEADERS)
+        await context.route("**/*", self._block_resources)
+        return await context.new_page()
+
+    async def _film_score(self, page):
+        rating = await page.query_selector("#movie-rat-avg")
+        return parse_score(await rating.inner_text()) if rating else None
+
+    async def _lookup(self, page, title, year):
+        """Returns ``(score, film_url)``, ``(None, None)`` if FilmAffinity has no match."""
+        await page.goto(search_url(title), wait_until="domcontentloaded", timeout=self.timeout)
+        if "search.php" not in page.url:
+            # Resultado único: FilmAffinity redirige a la ficha
+            return await self._film_score(page), page.url
+
+        chosen = None
+        results = await page.query_selector_all(".se-it")
+        for result in results:
+            year_box = await result.query_selector(".ye-w")
+            if year and year_box and (await year_box.inner_text()).strip() == str(year):
+                chosen = result
+                break
+        chosen = chosen or (results[0] if results else None)
+        if not chosen:
+            return None, None
+
+        href = None
+        for link in await chosen.query_selector_all("a"):
+            candidate = await link.get_attribute("href")
+            if candidate and "/film" in candidate:
+                href = candidate if candidate.startswith("http") else FA_URL + candidate
+                break
+        if not href:
+            return None, None
+
+        rating = await chosen.query_selector(".avgrat-box") or await chosen.query_selector(".rat-avg")
+        score = parse_score(await rating.inner_text()) if rating else None
+        if score is None:
+            await page.goto(href, wait_until="domcontentloaded", timeout=self.timeout)
+            score = await self._film_score(page)
+        return score, href
+
+    async def _run(self, queries, on_result):
+        queue = asyncio.Queue()
+        for idx, query in enumerate(queries):
+            queue.put_nowait((idx, query))
+
+        async def worker(page):
+            while True:
+                try:
+                    idx, (title, orig, year) = queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    return
+                try:
+                    score, url = await self._lookup(page, title or orig, year)
+                    if url is None and orig and orig != title:
+                        score, url = await self._lookup(page, orig, year)
+                    on_result(idx, (score, url), None)
+                except Exception as e:
+                    on_result(idx, None, e)
+
+        async with async_playwright() as pw:
+            browser = await pw.chromium.launch(headless=True)
+            try:
+                pages = await asyncio.gather(*(self._new_page(browser) for _ in range(min(self.size, len(queries)))))
+                await asyncio.gather(*(worker(page) for page in pages))
+            finally:
+                await browser.close()
+
+    def lookup_many(self, queries, on_result):
+        """Looks up ``(title, orig, year)`` tuples, calling ``on_result(idx, (score, url) | None, error)``."""
+        if queries:
+            asyncio.run(self._run(queries, on_result))
+
+
+class FACache:
+    """Mongo-backed cache of FilmAffinity scores and film URLs, keyed by title and year.
+
+    Same lifecycle as ``tmdb.TMDBCache``: expired entries are still served
+    until they are refreshed, and a TTL index drops them ``purge_after``
+    seconds later.
+    """
+
+    def __init__(self, collection, ttl=14 * 24 * 3600, negative_ttl=3 * 24 * 3600, purge_after=60 * 24 * 3600):
+        self.collection = collection
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.purge_after = purge_after
+        self._indexed = False
+
+    def _ensure_index(self):
+        if self._indexed:
+            return
+        try:
+            self.collection.create_index([("purge_at", ASCENDING)], expireAfterSeconds=0)
+            self._indexed = True
+        except Exception as e:
+            logger.warning(f"No se pudo crear el índice TTL de la caché FilmAffinity: {e}")
+
+    @staticmethod
+    def make_key(title, orig, year):
+        return f"{(title or orig or '').strip().lower()}|{year or 0}"
+
+    def get_many(self, keys):
+        try:
+            return {doc["_id"]: doc for doc in self.collection.find({"_id": {"$in": list(set(keys))}})}
+        except Exception as e:
+            logger.warning(f"Error leyendo caché FilmAffinity: {e}")
+            return {}
+
+    def put(self, key, score, url):
+        """Stores a lookup result. ``url=None`` records that FilmAffinity has no match."""
+        now = int(time.time())
+        ttl = self.ttl if url else self.negative_ttl
+        self._ensure_index()
+        try:
+            self.collection.update_one({"_id": key}, {"$set": {
+                "score": score,
+                "url": url,
+                "fetched_at": now,
+                "expires_at": now + ttl,
+                "purge_at": datetime.fromtimestamp(now + ttl + self.purge_after, tz=timezone.utc),
+            }}, upsert=True)
+        except Exception as e:
+            logger.warning(f"Error guardando caché FilmAffinity: {e}")
+
+
+class FAClient:
+    """FilmAffinity score provider: ``FACache`` first, then a ``FAPagePool`` scrape.
+
+    At most ``max_lookups`` titles are scraped per client (one client per
+    sync run), misses before stale entries, so a run never turns into a
+    multi-minute scrape; the rest are picked up by the following runs.
+    """
+
+    def __init__(self, cache, pool_size=3, max_lookups=100):
+        self.cache = cache
+        self.pool = FAPagePool(size=pool_size)
+        self.budget = max_lookups
+        self.stats = {"hits": 0, "stale": 0, "misses": 0, "deferred": 0, "scraped": 0, "errors": 0}
+
+    @property
+    def available(self):
+        return async_playwright is not None
+
+    def get_scores(self, lookups, on_progress=None):
+        """Resolves ``(title, orig, year)`` tuples to ``(score, film_url)``, in order.
+
+        Unknown entries are ``(None, None)``.
+        """
+        results = [(None, None)] * len(lookups)
+        keys = [FACache.make_key(*lookup) for lookup in lookups]
+        cached_docs = self.cache.get_many(keys)
+
+        misses, stale = {}, {}
+        for idx, (key, lookup) in enumerate(zip(keys, lookups)):
+            title, orig, year = lookup
+            if not (title or orig):
+                continue
+            cached = cached_docs.get(key)
+            if cached:
+                results[idx] = (cached.get("score"), cached.get("url"))
+                if cached.get("expires_at", 0) > time.time():
+                    self.stats["hits"] += 1
+                    continue
+                target = stale
+            else:
+                target = misses
+            target.setdefault(key, ([], lookup))[0].append(idx)
+        self.stats["misses"] = len(misses)
+        self.stats["stale"] = len(stale)
+
+        pending = list(misses.items()) + list(stale.items())
+        if pending and not self.available:
+            logger.warning("Playwright no está instalado: no se consultan notas de FilmAffinity")
+            pending = []
+        self.stats["deferred"] = max(0, len(pending) - self.budget)
+        pending = pending[:self.budget]
+
+        done = 0
+
+        def on_result(i, result, error):
+            nonlocal done
+            key, (indexes, lookup) = pending[i]
+            done += 1
+            if error is not None:
+                self.stats["errors"] += 1
+                logger.error(f"Error FilmAffinity for {lookup[0]}: {error}")
+            else:
+                self.stats["scraped"] += 1
+                self.cache.put(key, *result)
+                for idx in indexes:
+                    results[idx] = result
+            if on_progress:
+                on_progress(done, len(pending))
+
+        try:
+            self.pool.lookup_many([lookup for _, (_, lookup) in pending], on_result)
+        except Exception as e:
+            # Navegador que no arranca, etc.: se sigue con lo cacheado
+            logger.error(f"Error lanzando el navegador para FilmAffinity: {e}")
+        return results
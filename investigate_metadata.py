@@ -55,16 +55,17 @@ try:
     else:
         for lib in libraries:
             print(f"Librería: {lib['title']}")
-            items = plex.get_library_items(lib)
+            items = list(plex.get_library_items(lib))
             print(f"  Total items: {len(items)}")
             
             # Buscar coincidencia visual
             count = 0
             for item in items:
-                title = item.get("title", "")
-                year = item.get("year", "")
-                guid = item.get("guid", "")
-                ratingKey = item.get("ratingKey", "")
+                # Los campos que no trae el XML llegan como None
+                title = item.get("title") or ""
+                year = item.get("year") or ""
+                guid = item.get("guid") or ""
+                ratingKey = item.get("ratingKey") or ""
                 
                 # Mostrar si se parece a los targets o los primeros 3
                 if any(t in title.lower() for t in target_titles) or count < 3:
@@ -0,0 +1,148 @@
+import re
+import time
+import hashlib
+import logging
+import threading
+from pymongo import ASCENDING, UpdateOne
+
+logger = logging.getLogger(__name__)
+
+WRITE_BATCH = 1000
+
+
+def make_record(elem, lib_title):
+    """Compact server item as stored in the snapshot and consumed by ``LibraryMatcher``.
+
+    ``elem`` is one of the records yielded by ``PlexAPI.get_library_items``.
+    """
+    added_at = int(elem.get("addedAt", 0) or 0)
+    return {
+        "rating_key": elem.get("ratingKey"),
+        "title": (elem.get("title") or "").lower(),
+        "orig": (elem.get("originalTitle") or "").lower(),
+        "year": int(elem.get("year", 0) or 0),
+        "guid": elem.get("guid"),
+        "lib": lib_title,
+        "added_at": added_at,
+        "updated_at": int(elem.get("updatedAt", 0) or 0) or added_at,
+    }
+
+
+class LibrarySnapshot:
+    """Persistent copy of the server libraries, refreshed incrementally.
+
+    Every section keeps an ``updatedAt`` watermark in ``sections``; a normal
+    refresh only asks Plex for items updated since then. Every ``full_every``
+    seconds (or when a section has never been seen) the whole section is
+    downloaded again and items that disappeared from the server are removed.
+
+    The snapshot is keyed by server, not by account: tenants that watch the
+    same server share it. Refreshes of one server are serialized, and a
+    section read less than ``min_refresh_interval`` seconds ago is not asked
+    for again, so the second tenant reuses the first one's work.
+    """
+
+    def __init__(self, items_collection, sections_collection, full_every=24 * 3600, min_refresh_interval=300):
+        self.items = items_collection
+        self.sections = sections_collection
+        self.full_every = full_every
+        self.min_refresh_interval = min_refresh_interval
+        self._indexed = False
+        self._server_locks = {}
+        self._server_locks_lock = threading.Lock()
+
+    def _ensure_indexes(self):
+        if self._indexed:
+            return
+        self.items.create_index([("server", ASCENDING), ("section", ASCENDING), ("rating_key", ASCENDING)], unique=True)
+        self._indexed = True
+
+    def _lock_for(self, server_id):
+        with self._server_locks_lock:
+            return self._server_locks.setdefault(server_id, threading.Lock())
+
+    def _refresh_section(self, plex, server_id, lib):
+        """Updates one section. Returns the number of items read, or ``None`` if it was fresh enough."""
+        section_id = f"{server_id}:{lib['key']}"
+        state = self.sections.find_one({"_id": section_id}) or {}
+        now = int(time.time())
+        full = now - state.get("full_at", 0) >= self.full_every
+        if not full and now - state.get("synced_at", 0) < self.min_refresh_interval:
+            return None
+        since = None if full else state.get("watermark", 0)
+
+        watermark = state.get("watermark", 0)
+        seen = []
+        ops = []
+        count = 0
+        for elem in plex.get_library_items(lib, updated_since=since):
+            record = make_record(elem, lib["title"])
+            count += 1
+            watermark = max(watermark, record["updated_at"])
+            if not record["rating_key"]:
+                continue
+            seen.append(record["rating_key"])
+            ops.append(UpdateOne(
+                {"server": server_id, "section": lib["key"], "rating_key": record["rating_key"]},
+                {"$set": record},
+                upsert=True
+            ))
+            if len(ops) >= WRITE_BATCH:
+                self.items.bulk_write(ops, ordered=False)
+                ops = []
+        if ops:
+            self.items.bulk_write(ops, ordered=False)
+        if full:
+            # Reconciliación completa: lo que ya no está en Plex se ha borrado del servidor
+            self.items.delete_many({"server": server_id, "section": lib["key"], "rating_key": {"$nin": seen}})
+
+        state_update = {"title": lib["title"], "watermark": watermark, "synced_at": now}
+        if full:
+            state_update["full_at"] = now
+        self.sections.update_one({"_id": section_id}, {"$set": state_update}, upsert=True)
+        logger.info(f"Librería {lib['title']}: {count} elementos {'(completa)' if full else '(delta)'}")
+        return count
+
+    def refresh(self, plex, server_id, libraries):
+        """Brings the snapshot of ``server_id`` up to date.
+
+        Returns ``(server_items, stats, signature)``: the items for matching,
+        the refresh counters and a hash of the items (equal hashes mean the
+        match result cannot have changed). A section that cannot be read
+        keeps its previous snapshot, so a flaky connection no longer makes its
+        items look missing from the server.
+        """
+        self._ensure_indexes()
+        stats = {"sections": len(libraries), "section_errors": 0, "sections_reused": 0, "items_fetched": 0}
+        with self._lock_for(server_id):
+            for lib in libraries:
+                try:
+                    count = self._refresh_section(plex, server_id, lib)
+                    if count is None:
+                        stats["sections_reused"] += 1
+                    else:
+                        stats["items_fetched"] += count
+                except Exception as e:
+                    stats["section_errors"] += 1
+                    logger.warning(f"No se pudo leer la librería {lib.get('title')}: {e}")
+
+            # Secciones eliminadas del servidor
+            keys = [lib["key"] for lib in libraries]
+            self.items.delete_many({"server": server_id, "section": {"$nin": keys}})
+
+        server_items = []
+        projection = {"_id": 0, "title": 1, "orig": 1, "year": 1, "guid": 1, "lib": 1, "added_at": 1}
+        for lib in libraries:
+            cursor = self.items.find({"server": server_id, "section": lib["key"]}, projection)
+            server_items.extend(cursor.sort("rating_key", ASCENDING))
+
+        # Si no cambia, el resultado del cruce tampoco
+        digest = hashlib.sha1()
+        for item in server_items:
+            digest.update(f"{item['guid']}|{item['lib']}|{item['added_at']}|{item['title']}|{item['orig']}|{item['year']}\n".encode())
+        return server_items, stats, digest.hexdigest()
+
+    def forget(self, server_id):
+        """Deletes everything stored for ``server_id`` (e.g. the copy kept under its old key)."""
+        self.items.delete_many({"server": server_id})
+        self.sections.delete_many({"_id": {"$regex": f"^{re.escape(server_id)}:"}})
@@ -0,0 +1,97 @@
+from bisect import bisect_left
+from collections import defaultdict
+
+
+class LibraryMatcher:
+    """Resolves watchlist items against the server libraries using hash indexes.
+
+    The indexes are built once per sync from the ``server_items`` records built
+    in ``sync_watchlist`` (dicts with ``title``/``orig`` already lowercased,
+    ``year``, ``guid``, ``lib`` and ``added_at``). Every lookup touches only the
+    candidates sharing a GUID or a title/year bucket instead of the whole server.
+
+    The ratingKey check keeps the original ``guid.endswith(ratingKey)``
+    semantics: GUIDs are kept reversed and sorted, so every GUID ending in a
+    ratingKey is a contiguous range found by binary search.
+    """
+
+    def __init__(self, server_items):
+        self.server_items = server_items
+        self._by_guid = defaultdict(list)
+        self._by_title = defaultdict(lambda: defaultdict(list))
+
+        for pos, s_item in enumerate(server_items):
+            guid = s_item["guid"]
+            if guid:
+                self._by_guid[guid].append(pos)
+
+            if s_item["year"] > 0:
+                names = {s_item["title"], s_item["orig"]}
+                names.discard("")
+                for name in names:
+                    self._by_title[name][s_item["year"]].append(pos)
+
+        # plex://movie/<ratingKey> termina en el ratingKey: sufijo de la GUID = prefijo de la GUID invertida
+        self._reversed = sorted((s_item["guid"][::-1], pos) for pos, s_item in enumerate(server_items) if s_item["guid"])
+        self._reversed_keys = [rev for rev, _ in self._reversed]
+
+    def _suffix_candidates(self, suffix):
+        prefix = suffix[::-1]
+        found = set()
+        for i in range(bisect_left(self._reversed_keys, prefix), len(self._reversed)):
+            rev, pos = self._reversed[i]
+            if not rev.startswith(prefix):
+                break
+            found.add(pos)
+        return found
+
+    def _guid_candidates(self, item):
+        plex_id = item.get("ratingKey")
+        guid = item.get("guid")
+        found = set()
+        if plex_id:
+            found.update(self._suffix_candidates(plex_id))
+        if guid:
+            found.update(self._by_guid.get(guid, ()))
+        return found
+
+    def _title_candidates(self, item):
+        year = item.get("year") or 0
+        if year <= 0:
+            return set()
+
+        keys = {item.get("title"), item.get("originalTitle")}
+        found = set()
+        for key in keys:
+            if not key:
+                continue
+            buckets = self._by_title.get(key.lower())
+            if not buckets:
+                continue
+            for y in (year - 1, year, year + 1):
+                found.update(buckets.get(y, ()))
+        return found
+
+    def match(self, item):
+        """Returns ``(on_server, libraries, added_at)`` for a raw watchlist item.
+
+        Mirrors the original linear scan: server items are visited in library
+        order, every GUID or title+year (±1) hit counts, and the scan stops at
+        the first GUID hit. ``added_at`` comes from the last hit visited.
+        """
+        guid_hits = self._guid_candidates(item)
+        hits = guid_hits | self._title_candidates(item)
+        if not hits:
+            return False, [], 0
+
+        if guid_hits:
+            stop = min(guid_hits)
+            hits = [pos for pos in hits if pos <= stop]
+        ordered = sorted(hits)
+
+        libraries = []
+        for pos in ordered:
+            lib = self.server_items[pos]["lib"]
+            if lib not in libraries:
+                libraries.append(lib)
+        return True, libraries, self.server_items[ordered[-1]]["added_at"]
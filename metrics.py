@@ -0,0 +1,174 @@
+import time
+import logging
+from collections import defaultdict
+from pymongo.errors import CollectionInvalid
+from constants import LATENCY_BUCKETS
+
+logger = logging.getLogger(__name__)
+
+TOTALS_ID = "metrics_totals"
+PREFIX = "plexwl"
+
+
+class RunMetrics:
+    """Timings and counters of a single sync run.
+
+    The sync is a linear pipeline, so ``stage(name)`` closes the stage in
+    progress and opens the next one; ``finish()`` closes the last one.
+    """
+
+    def __init__(self, run_id):
+        self.run_id = run_id
+        self.started_at = time.time()
+        self.stages = {}
+        self.counters = defaultdict(int)
+        self._stage = None
+        self._stage_start = None
+
+    def stage(self, name):
+        self._close_stage()
+        self._stage = name
+        self._stage_start = time.perf_counter()
+
+    def _close_stage(self):
+        if self._stage:
+            elapsed = time.perf_counter() - self._stage_start
+            self.stages[self._stage] = self.stages.get(self._stage, 0) + elapsed
+            self._stage = None
+
+    def count(self, name, value=1):
+        self.counters[name] += value
+
+    def finish(self):
+        self._close_stage()
+        return time.time() - self.started_at
+
+
+class MetricsStore:
+    """Persists run breakdowns and cluster-wide totals, and renders them for Prometheus.
+
+    Every run is appended to the capped ``history`` collection (the last
+    ``history_size`` runs) and added to a totals document, so ``/api/metrics``
+    returns the same monotonic counters whichever worker serves it.
+    """
+
+    def __init__(self, db, history_name="sync_runs", totals_collection=None, history_size=200):
+        self.db = db
+        self.history_name = history_name
+        self.totals = totals_collection
+        self.history_size = history_size
+        self._history = None
+
+    @property
+    def history(self):
+        if self._history is None:
+            try:
+                self.db.create_collection(self.history_name, capped=True, size=5 * 1024 * 1024, max=self.history_size)
+            except CollectionInvalid:
+                pass  # Ya existe
+            except Exception as e:
+                logger.warning(f"No se pudo crear la colección limitada {self.history_name}: {e}")
+            self._history = self.db[self.history_name]
+        return self._history
+
+    def record(self, run, status, plex_stats=None, tenant_id=None):
+        """Stores ``run`` (a finished ``RunMetrics``) with its outcome and the PlexAPI request stats."""
+        duration = run.finish()
+        plex_stats = plex_stats or {}
+        doc = {
+            "run_id": run.run_id,
+            "tenant_id": tenant_id,
+            "status": status,
+            "started_at": run.started_at,
+            "duration": duration,
+            "stages": run.stages,
+            "counters": dict(run.counters),
+            "plex": {name: {k: v for k, v in data.items() if k != "histogram"} for name, data in plex_stats.items()},
+        }
+
+        inc = {f"runs.{status}": 1, "duration_seconds": duration}
+        for stage, seconds in run.stages.items():
+            inc[f"stage_seconds.{stage}"] = seconds
+        for name, value in run.counters.items():
+            inc[f"counters.{name}"] = value
+        for endpoint, data in plex_stats.items():
+            inc[f"plex.{endpoint}.requests"] = data["requests"]
+            inc[f"plex.{endpoint}.errors"] = data["errors"]
+            inc[f"plex.{endpoint}.seconds"] = data["seconds"]
+            for i, count in enumerate(data["histogram"]):
+                if count:
+                    inc[f"plex.{endpoint}.buckets.b{i}"] = count
+
+        try:
+            self.history.insert_one(doc)
+            self.totals.update_one(
+                {"id": TOTALS_ID},
+                {"$inc": inc, "$set": {"last_run_id": run.run_id}},
+                upsert=True
+            )
+        except Exception as e:
+            logger.warning(f"No se pudieron guardar las métricas de la sincronización: {e}")
+        logger.info(f"Sincronización {run.run_id}: {duration:.1f}s, etapas {({k: round(v, 2) for k, v in run.stages.items()})}")
+
+    def add_counters(self, counters, prefix=""):
+        """Adds ``counters`` to the totals, for events that happen outside a sync run (Telegram dispatches)."""
+        inc = {f"counters.{prefix}{name}": value for name, value in counters.items() if value}
+        if not inc:
+            return
+        try:
+            self.totals.update_one({"id": TOTALS_ID}, {"$inc": inc}, upsert=True)
+        except Exception as e:
+            logger.warning(f"No se pudieron guardar las métricas: {e}")
+
+    def last_runs(self, limit=20):
+        return list(self.history.find({}, {"_id": 0}).sort("$natural", -1).limit(limit))
+
+    def render_prometheus(self):
+        totals = self.totals.find_one({"id": TOTALS_ID}) or {}
+        last = self.last_runs(1)
+        last = last[0] if last else {}
+        lines = []
+
+        def metric(name, kind, help_text, samples):
+            lines.append(f"# HELP {PREFIX}_{name} {help_text}")
+            lines.append(f"# TYPE {PREFIX}_{name} {kind}")
+            for labels, value in samples:
+                label_str = ",".join(f'{k}="{v}"' for k, v in labels.items())
+                lines.append(f"{PREFIX}_{name}{{{label_str}}} {value}" if label_str else f"{PREFIX}_{name} {value}")
+
+        metric("sync_runs_total", "counter", "Finished syncs by outcome.",
+               [({"status": k}, v) for k, v in sorted(totals.get("runs", {}).items())])
+        metric("sync_duration_seconds_total", "counter", "Total time spent syncing.",
+               [({}, totals.get("duration_seconds", 0))])
+        metric("sync_stage_seconds_total", "counter", "Total time spent in each sync stage.",
+               [({"stage": k}, v) for k, v in sorted(totals.get("stage_seconds", {}).items())])
+        metric("sync_events_total", "counter", "Sync counters (pages, items, TMDB calls, Telegram sends...).",
+               [({"name": k}, v) for k, v in sorted(totals.get("counters", {}).items())])
+
+        metric("last_sync_timestamp_seconds", "gauge", "Start time of the last recorded sync.",
+               [({}, last.get("started_at", 0))])
+        metric("last_sync_duration_seconds", "gauge", "Duration of the last recorded sync.",
+               [({}, last.get("duration", 0))])
+        metric("last_sync_stage_seconds", "gauge", "Stage breakdown of the last recorded sync.",
+               [({"stage": k}, v) for k, v in sorted(last.get("stages", {}).items())])
+        metric("last_sync_success", "gauge", "1 if the last recorded sync succeeded.",
+               [({}, 1 if last.get("status") == "success" else 0)])
+
+        plex = totals.get("plex", {})
+        metric("plex_requests_total", "counter", "Requests made to Plex, by endpoint.",
+               [({"endpoint": k}, v.get("requests", 0)) for k, v in sorted(plex.items())])
+        metric("plex_request_errors_total", "counter", "Plex requests that did not return 200.",
+               [({"endpoint": k}, v.get("errors", 0)) for k, v in sorted(plex.items())])
+        lines.append(f"# HELP {PREFIX}_plex_request_seconds Latency of Plex requests.")
+        lines.append(f"# TYPE {PREFIX}_plex_request_seconds histogram")
+        for endpoint, data in sorted(plex.items()):
+            buckets = data.get("buckets", {})
+            cumulative = 0
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                cumulative += buckets.get(f"b{i}", 0)
+                le = "+Inf" if bound == float("inf") else bound
+                lines.append(f'{PREFIX}_plex_request_seconds_bucket{{endpoint="{endpoint}",le="{le}"}} {cumulative}')
+            lines.append(f'{PREFIX}_plex_request_seconds_sum{{endpoint="{endpoint}"}} {data.get("seconds", 0)}')
+            lines.append(f'{PREFIX}_plex_request_seconds_count{{endpoint="{endpoint}"}} {data.get("requests", 0)}')
+
+        return "\n".join(lines) + "\n"
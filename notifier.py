@@ -0,0 +1,228 @@
+import html
+import time
+import uuid
+import logging
+import threading
+from collections import Counter
+import requests
+from pymongo import ASCENDING, UpdateOne
+from tmdb import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+TELEGRAM_API_URL = "https://api.telegram.org"
+ITEM_FIELDS = ("plex_id", "title", "year", "type", "libraries", "url")
+MAX_BACKOFF = 6 * 3600
+
+
+def format_message(items):
+    """Telegram HTML announcing ``items`` (one card, or a list if there are several).
+
+    Titles and library names are escaped: a ``<`` or ``&`` in them must not
+    make Telegram reject the message.
+    """
+    def esc(value):
+        return html.escape(str(value))
+
+    if len(items) == 1:
+        item = items[0]
+        msg = "🍿 <b>¡Nuevo en tu Plex!</b>\n\n"
+        msg += f"🎬 <b>{esc(item['title'])}</b> ({esc(item['year'])})\n"
+        msg += f"📁 Tipo: {esc(item['type'])}\n"
+        msg += f"📍 Disponible en: {esc(', '.join(item['libraries']))}\n\n"
+        msg += f'<a href="{esc(item["url"])}">Ver en FilmAffinity</a>'
+        return msg
+    lines = [f"🍿 <b>¡{len(items)} novedades en tu Plex!</b>", ""]
+    for item in items:
+        lines.append(f"🎬 <b>{esc(item['title'])}</b> ({esc(item['year'])}) · 📍 {esc(', '.join(item['libraries']))} · "
+                     f'<a href="{esc(item["url"])}">FilmAffinity</a>')
+    return "\n".join(lines)
+
+
+class TelegramOutbox:
+    """Mongo outbox of "now available on the server" announcements for one Telegram chat.
+
+    The sync only ``enqueue``s events, keyed by ``plex_id`` within
+    ``tenant_id``: the key is unique and never reset, so a title is announced
+    at most once per tenant. ``dispatch`` drains
+    due events in messages of up to ``batch_size`` titles, sends at most
+    ``per_minute`` messages a minute (Telegram's limit for groups), honours
+    ``retry_after`` on 429 and retries other failures with exponential
+    backoff, giving up after ``max_attempts``. Batches are claimed with a
+    ``lease``, so dispatchers in several workers never send the same event
+    concurrently. ``on_dispatch(stats)`` receives the outcome counts of every
+    dispatch that did something (see ``dispatch``).
+    """
+
+    def __init__(self, collection, bot_token, chat_id, tenant_id, batch_size=10, per_minute=20, max_attempts=8,
+                 base_backoff=30, lease=120, api_url=TELEGRAM_API_URL, on_dispatch=None):
+        self.collection = collection
+        self.tenant_id = tenant_id
+        self.bot_token = bot_token
+        self.chat_id = chat_id
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.base_backoff = base_backoff
+        self.lease = lease
+        self.api_url = api_url
+        self.on_dispatch = on_dispatch
+        self.bucket = TokenBucket(per_minute / 60, capacity=1)
+        self.session = requests.Session()
+        self._indexed = False
+        self._draining = threading.Lock()
+
+    @property
+    def enabled(self):
+        return bool(self.bot_token and self.chat_id)
+
+    def _ensure_indexes(self):
+        if not self._indexed:
+            self.collection.create_index([("tenant_id", ASCENDING), ("key", ASCENDING)], unique=True)
+            self.collection.create_index([("tenant_id", ASCENDING), ("status", ASCENDING), ("next_attempt_at", ASCENDING)])
+            self._indexed = True
+
+    def enqueue(self, items):
+        """Queues an announcement for each of ``items``. Returns how many were not queued before."""
+        if not self.enabled or not items:
+            return 0
+        self._ensure_indexes()
+        now = time.time()
+        ops = [
+            UpdateOne(
+                {"tenant_id": self.tenant_id, "key": item["plex_id"]},
+                {"$setOnInsert": {
+                    "tenant_id": self.tenant_id,
+                    "key": item["plex_id"],
+                    "item": {k: item.get(k) for k in ITEM_FIELDS},
+                    "status": "pending",
+                    "attempts": 0,
+                    "created_at": now,
+                    "next_attempt_at": now
+                }},
+                upsert=True
+            )
+            for item in items
+        ]
+        return self.collection.bulk_write(ops, ordered=False).upserted_count
+
+    def _claim(self):
+        """Leases up to ``batch_size`` due events (oldest first) and returns them with the claim token."""
+        now = time.time()
+        claimable = {"tenant_id": self.tenant_id, "$or": [
+            {"status": "pending", "next_attempt_at": {"$lte": now}},
+            {"status": "sending", "lease_until": {"$lt": now}}  # Dispatcher caído a mitad de envío
+        ]}
+        ids = [d["_id"] for d in self.collection.find(claimable, {"_id": 1}).sort("created_at", ASCENDING).limit(self.batch_size)]
+        if not ids:
+            return [], None
+        token = uuid.uuid4().hex
+        self.collection.update_many(
+            {"$and": [{"_id": {"$in": ids}}, claimable]},
+            {"$set": {"status": "sending", "claim": token, "lease_until": now + self.lease}}
+        )
+        return list(self.collection.find({"claim": token}).sort("created_at", ASCENDING)), token
+
+    def _release(self, doc_filter, fields):
+        self.collection.update_many(doc_filter, {"$set": fields, "$unset": {"claim": "", "lease_until": ""}})
+
+    def _deliver(self, docs, token, stats):
+        """Sends one message for ``docs``, records the outcome and counts it in ``stats``.
+
+        Returns "sent", "throttled", "failed" (to be retried) or "rejected"
+        (Telegram refused the message itself; retrying cannot fix it).
+        """
+        mine = {"_id": {"$in": [d["_id"] for d in docs]}, "claim": token}
+        error = None
+        resp = None
+        try:
+            self.bucket.acquire()
+            stats["messages"] += 1
+            resp = self.session.post(
+                f"{self.api_url}/bot{self.bot_token}/sendMessage",
+                json={
+                    "chat_id": self.chat_id,
+                    "text": format_message([d["item"] for d in docs]),
+                    "parse_mode": "HTML",
+                    "disable_web_page_preview": len(docs) > 1
+                },
+                timeout=10
+            )
+        except requests.RequestException as e:
+            error = str(e)
+
+        if resp is not None and resp.ok:
+            self._release(mine, {"status": "sent", "sent_at": time.time()})
+            stats["sent"] += len(docs)
+            return "sent"
+        if resp is not None and resp.status_code == 429:
+            try:
+                retry_after = resp.json().get("parameters", {}).get("retry_after", self.base_backoff)
+            except ValueError:
+                retry_after = self.base_backoff
+            # Limitado por Telegram: no es culpa de estos avisos, no cuenta como intento
+            self._release(mine, {"status": "pending", "next_attempt_at": time.time() + retry_after})
+            stats["throttled"] += len(docs)
+            return "throttled"
+        if resp is not None and resp.status_code == 400 and len(docs) > 1:
+            # Un título que Telegram rechaza no debe bloquear al resto: se reenvían uno a uno
+            outcomes = [self._deliver([doc], token, stats) for doc in docs]
+            return next((o for o in ("throttled", "failed") if o in outcomes), "sent")
+        if resp is not None and resp.status_code == 400:
+            # Petición inválida: reintentarla daría el mismo 400, se descarta ya
+            error = f"HTTP 400: {resp.text[:200]}"
+            self._release(mine, {"status": "failed", "attempts": docs[0].get("attempts", 0) + 1, "last_error": error})
+            stats["discarded"] += 1
+            logger.error(f"Aviso de Telegram rechazado: {docs[0]['item']['title']} ({error})")
+            return "rejected"
+
+        error = error or f"HTTP {resp.status_code}: {resp.text[:200]}"
+        now = time.time()
+        for doc in docs:
+            attempts = doc.get("attempts", 0) + 1
+            gave_up = attempts >= self.max_attempts
+            self._release({"_id": doc["_id"], "claim": token}, {
+                "status": "failed" if gave_up else "pending",
+                "attempts": attempts,
+                "last_error": error,
+                "next_attempt_at": now + min(self.base_backoff * 2 ** (attempts - 1), MAX_BACKOFF)
+            })
+            stats["discarded" if gave_up else "failed"] += 1
+            if gave_up:
+                logger.error(f"Aviso de Telegram descartado tras {attempts} intentos: {doc['item']['title']} ({error})")
+        logger.warning(f"Error enviando Telegram ({len(docs)} avisos, se reintentará): {error}")
+        return "failed"
+
+    def dispatch(self):
+        """Sends every due announcement. Returns the number of events by outcome.
+
+        Outcomes are "sent", "throttled", "failed" (to be retried) and
+        "discarded" (gave up, or rejected by Telegram), plus the number of
+        "messages" attempted.
+        Stops early when Telegram fails or throttles; the scheduler calls this
+        again later. Only one dispatch runs at a time per process.
+        """
+        stats = Counter()
+        if not self.enabled or not self._draining.acquire(blocking=False):
+            return stats
+        try:
+            self._ensure_indexes()
+            while True:
+                docs, token = self._claim()
+                if not docs:
+                    break
+                if self._deliver(docs, token, stats) in ("throttled", "failed"):
+                    break
+        except Exception as e:
+            logger.error(f"Error despachando avisos de Telegram: {e}")
+        finally:
+            self._draining.release()
+        if stats:
+            logger.info(f"Avisos de Telegram: {dict(stats)}")
+            if self.on_dispatch:
+                self.on_dispatch(stats)
+        return stats
+
+    def dispatch_async(self):
+        """Runs ``dispatch`` in a background thread, so the caller never waits for Telegram."""
+        if self.enabled:
+            threading.Thread(target=self.dispatch, name="telegram-outbox", daemon=True).start()
@@ -1,68 +1,340 @@
+import time
+import hashlib
+import logging
+import threading
 import requests
 import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from constants import DEFAULT_PLEX_DISCOVER_URL, DEFAULT_PLEX_TV_URL, LATENCY_BUCKETS
+
+logger = logging.getLogger(__name__)
+
+# Atributos de cada elemento de librería que se conservan (lo que necesita el cruce)
+LIBRARY_FIELDS = ("ratingKey", "title", "originalTitle", "year", "guid", "addedAt", "updatedAt")
+LIBRARY_PAGE_SIZE = 500
+WATCHLIST_PAGE_SIZE = 100
+# Campos de cada elemento de la watchlist que necesita la sincronización (se guardan para reutilizarlos)
+WATCHLIST_FIELDS = ("ratingKey", "guid", "Guid", "title", "originalTitle", "year", "type", "thumb")
+
+DISCOVER_URL = DEFAULT_PLEX_DISCOVER_URL
+PLEX_TV_URL = DEFAULT_PLEX_TV_URL
+
+
+class RequestStats:
+    """Thread-safe request counters and latency histograms, grouped by endpoint."""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._endpoints = {}
+
+    def observe(self, endpoint, seconds, ok=True):
+        with self._lock:
+            data = self._endpoints.setdefault(endpoint, {
+                "requests": 0,
+                "errors": 0,
+                "seconds": 0.0,
+                "histogram": [0] * len(self.buckets),
+            })
+            data["requests"] += 1
+            data["seconds"] += seconds
+            if not ok:
+                data["errors"] += 1
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    data["histogram"][i] += 1
+                    break
+
+    def snapshot(self):
+        with self._lock:
+            return {name: dict(data, histogram=list(data["histogram"])) for name, data in self._endpoints.items()}
+
+    def summary(self):
+        """Compact one-line form for logs: ``endpoint=requests/errors/avg_ms``."""
+        parts = []
+        for name, data in sorted(self.snapshot().items()):
+            avg_ms = 1000 * data["seconds"] / data["requests"] if data["requests"] else 0
+            parts.append(f"{name}={data['requests']}/{data['errors']}/{avg_ms:.0f}ms")
+        return " ".join(parts)
+
+
+def _build_session(pool_size, retries, backoff):
+    retry = Retry(
+        total=retries,
+        backoff_factor=backoff,
+        status_forcelist=(500, 502, 503, 504),
+        allowed_methods=frozenset(["GET"]),
+        raise_on_status=False
+    )
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def connection_class(conn):
+    """``local``, ``relay`` or ``remote`` for a plex.tv ``Connection`` element."""
+    if conn.get("relay") == "1":
+        return "relay"
+    return "local" if conn.get("local") == "1" else "remote"
+
+
+class ServerCache:
+    """Remembers how to reach each server: address, access token, identifier and sections.
+
+    One document per account and server name in ``collection`` (the access
+    token of a shared server differs per account). Entries are reused for
+    ``ttl`` seconds; the class of URI that won the last discovery is kept
+    after that so the next discovery probes it first.
+    """
+
+    def __init__(self, collection, ttl=12 * 3600):
+        self.collection = collection
+        self.ttl = ttl
+
+    @staticmethod
+    def make_key(account_token, server_name):
+        return f"{hashlib.sha1((account_token or '').encode()).hexdigest()[:12]}:{server_name}"
+
+    def get(self, key):
+        try:
+            return self.collection.find_one({"_id": key}) or {}
+        except Exception as e:
+            logger.warning(f"Error leyendo la caché de servidores: {e}")
+            return {}
+
+    def put(self, key, server_id, address, token, sections, uri_class):
+        try:
+            self.collection.update_one({"_id": key}, {"$set": {
+                "server_id": server_id,
+                "address": address,
+                "token": token,
+                "sections": sections,
+                "uri_class": uri_class,
+                "expires_at": time.time() + self.ttl
+            }}, upsert=True)
+        except Exception as e:
+            logger.warning(f"Error guardando la caché de servidores: {e}")
+
+    def invalidate(self, key):
+        """Forces the next lookup to rediscover the server (the preferred URI class is kept)."""
+        try:
+            self.collection.update_one({"_id": key}, {"$set": {"expires_at": 0}})
+        except Exception as e:
+            logger.warning(f"Error invalidando la caché de servidores: {e}")
+
+
+def watchlist_fingerprint(total, first_page):
+    """Cheap summary of the watchlist: its size plus the ratingKeys of the first (newest) page.
+
+    Additions land on the first page and removals change the size, so an
+    equal fingerprint means the list has not changed.
+    """
+    keys = ",".join(item.get("ratingKey") or "" for item in first_page)
+    return f"{total}:{hashlib.sha1(keys.encode()).hexdigest()[:16]}"
+
 
 class PlexAPI:
-    def __init__(self, token):
+    def __init__(self, token, pool_size=10, retries=3, backoff=0.5, discover_url=DISCOVER_URL, plex_tv_url=PLEX_TV_URL,
+                 page_workers=4, server_cache=None, probe_head_start=0.3):
         self.token = token
+        self.server_cache = server_cache
+        self.probe_head_start = probe_head_start
+        # True si las últimas librerías devueltas salieron de la caché sin comprobar la conexión
+        self.libraries_cached = False
+        self.page_workers = page_workers
+        self.watchlist_fingerprint = None
+        self.discover_url = discover_url
+        self.plex_tv_url = plex_tv_url
         self.headers = {
             "Accept": "application/json",
             "X-Plex-Language": "es"
         }
+        # Sesión compartida: keep-alive por host y reintentos con backoff en 5xx/timeouts
+        self.session = _build_session(pool_size, retries, backoff)
+        # Las sondas de conexión no reintentan: una URI caída debe descartarse rápido
+        self.probe_session = _build_session(pool_size, 0, 0)
+        self.stats = RequestStats()
 
-    def get_watchlist(self):
-        """Fetches all items from the Plex Universal Watchlist with pagination."""
-        items = []
-        start = 0
-        size = 100
-        while True:
-            url = f"https://discover.provider.plex.tv/library/sections/watchlist/all?X-Plex-Token={self.token}&X-Plex-Container-Start={start}&X-Plex-Container-Size={size}"
-            resp = requests.get(url, headers=self.headers, timeout=15)
-            if resp.status_code == 200:
-                data = resp.json().get("MediaContainer", {})
-                batch = data.get("Metadata", [])
-                items.extend(batch)
-                total = data.get("totalSize", 0)
-                if len(items) >= total or not batch:
-                    break
-                start += size
-            else:
-                break
+    def _get(self, endpoint, url, session=None, **kwargs):
+        """GET through the pooled session, recording latency and outcome under ``endpoint``."""
+        start = time.monotonic()
+        ok = False
+        try:
+            resp = (session or self.session).get(url, **kwargs)
+            ok = resp.status_code == 200
+            return resp
+        finally:
+            self.stats.observe(endpoint, time.monotonic() - start, ok)
+
+    def _watchlist_page(self, start, size=WATCHLIST_PAGE_SIZE):
+        """Returns ``(items, totalSize)`` for one page, or ``(None, 0)`` if Plex did not answer 200."""
+        url = f"{self.discover_url}/library/sections/watchlist/all?X-Plex-Token={self.token}&includeGuids=1&X-Plex-Container-Start={start}&X-Plex-Container-Size={size}"
+        resp = self._get("watchlist", url, headers=self.headers, timeout=15)
+        if resp.status_code != 200:
+            logger.warning(f"Watchlist: respuesta {resp.status_code} en la página {start}")
+            return None, 0
+        data = resp.json().get("MediaContainer", {})
+        return data.get("Metadata", []), data.get("totalSize", 0)
+
+    def get_watchlist(self, known_fingerprint=None):
+        """Fetches all items from the Plex Universal Watchlist with pagination.
+
+        The first page reveals ``totalSize``; the remaining pages are then
+        requested concurrently on ``page_workers`` threads. The fingerprint of
+        the list is left in ``self.watchlist_fingerprint``; if it equals
+        ``known_fingerprint`` the rest is not downloaded and ``None`` is returned.
+        """
+        size = WATCHLIST_PAGE_SIZE
+        first, total = self._watchlist_page(0, size)
+        if not first:
+            return []
+        self.watchlist_fingerprint = watchlist_fingerprint(total, first)
+        if known_fingerprint and self.watchlist_fingerprint == known_fingerprint:
+            return None
+
+        items = list(first)
+        starts = range(len(first), total, size)
+        if starts:
+            with ThreadPoolExecutor(max_workers=min(self.page_workers, len(starts))) as pool:
+                for start, (batch, _) in zip(starts, pool.map(lambda s: self._watchlist_page(s, size), starts)):
+                    if batch is None:
+                        # Una lista incompleta borraría de Mongo los elementos que faltan
+                        raise RuntimeError(f"No se pudo descargar la página {start} de la watchlist")
+                    items.extend(batch)
         return items
 
-    def get_server_libraries(self, server_name="Navidad"):
-        """Discovers servers and returns libraries for a specific server."""
-        resources_url = f"https://plex.tv/api/resources?includeHttps=1&X-Plex-Token={self.token}"
-        resp = requests.get(resources_url, timeout=10)
-        if resp.status_code != 200: return []
-        
+    def _probe(self, address, access_token):
+        """Returns the sections of the server at ``address``, or ``None`` if it does not answer."""
+        try:
+            sections_url = f"{address}/library/sections?X-Plex-Token={access_token}"
+            sec_resp = self._get("sections", sections_url, session=self.probe_session, timeout=5, verify=False)
+            if sec_resp.status_code == 200:
+                sec_root = ET.fromstring(sec_resp.content)
+                return [{"title": s.get("title"), "key": s.get("key")} for s in sec_root.findall(".//Directory")]
+        except Exception as e:
+            logger.info(f"Conexión {address} no disponible: {e}")
+        return None
+
+    def _race(self, connections, access_token, preferred):
+        """Probes ``connections`` concurrently and returns ``(conn, sections)`` for the first healthy one.
+
+        Connections of the ``preferred`` class start ``probe_head_start``
+        seconds ahead; the rest join as soon as that delay passes or every
+        preferred probe has failed.
+        """
+        first = [c for c in connections if connection_class(c) == preferred]
+        later = [c for c in connections if connection_class(c) != preferred]
+        if not first:
+            first, later = later, []
+        pool = ThreadPoolExecutor(max_workers=len(connections))
+        try:
+            futures = {pool.submit(self._probe, c.get("uri"), access_token): c for c in first}
+            pending = set(futures)
+            deadline = time.monotonic() + self.probe_head_start
+            while pending:
+                timeout = max(0, deadline - time.monotonic()) if later else None
+                done, pending = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+                for future in done:
+                    if future.result() is not None:
+                        return futures[future], future.result()
+                if later and (not pending or time.monotonic() >= deadline):
+                    for c in later:
+                        future = pool.submit(self._probe, c.get("uri"), access_token)
+                        futures[future] = c
+                        pending.add(future)
+                    later = []
+            return None, None
+        finally:
+            # Las sondas perdedoras terminan solas (timeout de 5 s); no se las espera
+            pool.shutdown(wait=False)
+
+    def get_server_libraries(self, server_name="Navidad", refresh=False):
+        """Discovers servers and returns libraries for a specific server.
+
+        With a ``server_cache`` the address, token and sections found last
+        time are reused until they expire (or ``refresh`` is set). Discovery
+        probes every connection of the server concurrently and keeps the first
+        that answers. Every library carries the ``server_id`` of its server
+        (the device's ``clientIdentifier``, the same for every account).
+        """
+        cache_key = ServerCache.make_key(self.token, server_name)
+        cached = self.server_cache.get(cache_key) if self.server_cache else {}
+        self.libraries_cached = False
+        if cached.get("sections") and cached.get("expires_at", 0) > time.time() and not refresh:
+            self.libraries_cached = True
+            server_id = cached.get("server_id") or server_name
+            return [dict(s, address=cached["address"], token=cached["token"], server_id=server_id) for s in cached["sections"]]
+
+        resources_url = f"{self.plex_tv_url}/api/resources?includeHttps=1&X-Plex-Token={self.token}"
+        resp = self._get("resources", resources_url, timeout=10)
+        if resp.status_code != 200:
+            logger.warning(f"plex.tv/api/resources respondió {resp.status_code}")
+            return []
+
         root = ET.fromstring(resp.content)
         devices = root.findall(".//Device[@provides='server']")
-        
+
         for device in devices:
             if device.get("name") == server_name:
                 access_token = device.get("accessToken")
                 connections = device.findall("Connection")
-                for conn in connections:
-                    address = conn.get("uri")
-                    try:
-                        sections_url = f"{address}/library/sections?X-Plex-Token={access_token}"
-                        sec_resp = requests.get(sections_url, timeout=5, verify=False)
-                        if sec_resp.status_code == 200:
-                            sec_root = ET.fromstring(sec_resp.content)
-                            return [{
-                                "title": s.get("title"),
-                                "key": s.get("key"),
-                                "address": address,
-                                "token": access_token
-                            } for s in sec_root.findall(".//Directory")]
-                    except: continue
+                if not connections:
+                    continue
+                conn, sections = self._race(connections, access_token, cached.get("uri_class", "remote"))
+                if conn is None:
+                    continue
+                address = conn.get("uri")
+                server_id = device.get("clientIdentifier") or server_name
+                logger.info(f"Servidor {server_name} accesible en {address} ({connection_class(conn)})")
+                if self.server_cache:
+                    self.server_cache.put(cache_key, server_id, address, access_token, sections, connection_class(conn))
+                return [dict(s, address=address, token=access_token, server_id=server_id) for s in sections]
         return []
 
-    def get_library_items(self, library):
-        """Fetches all items from a specific library section."""
-        url = f"{library['address']}/library/sections/{library['key']}/all?X-Plex-Token={library['token']}"
-        resp = requests.get(url, timeout=20, verify=False)
-        if resp.status_code == 200:
-            root = ET.fromstring(resp.content)
-            return root.findall(".//Video") or root.findall(".//Directory")
-        return []
+    def get_library_items(self, library, updated_since=None, page_size=LIBRARY_PAGE_SIZE):
+        """Yields compact records for every item of a library section.
+
+        The section is read in pages of ``page_size`` and each page is parsed
+        incrementally, so memory stays flat regardless of the library size.
+        With ``updated_since`` (unix timestamp) only items added or modified
+        since then are returned, using Plex's ``updatedAt>>=`` filter.
+        """
+        base_url = f"{library['address']}/library/sections/{library['key']}/all?X-Plex-Token={library['token']}"
+        if updated_since:
+            base_url += f"&updatedAt>>={int(updated_since)}"
+
+        start = 0
+        while True:
+            url = f"{base_url}&X-Plex-Container-Start={start}&X-Plex-Container-Size={page_size}"
+            count, total = 0, 0
+            resp = self._get("library_items", url, timeout=20, verify=False, stream=True)
+            try:
+                # Un error no puede confundirse con una sección vacía: el snapshot borraría su contenido
+                resp.raise_for_status()
+                resp.raw.decode_content = True
+                root = None
+                for event, elem in ET.iterparse(resp.raw, events=("start", "end")):
+                    if event == "start":
+                        if root is None:
+                            root = elem
+                            total = int(elem.get("totalSize") or elem.get("size") or 0)
+                        continue
+                    if elem.tag in ("Video", "Directory") and elem.get("ratingKey"):
+                        count += 1
+                        yield {field: elem.get(field) for field in LIBRARY_FIELDS}
+                        root.clear()
+            finally:
+                resp.close()
+
+            start += count
+            if not count:
+                break
+            if total:
+                if start >= total:
+                    break
+            elif count < page_size:
+                break
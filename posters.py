@@ -0,0 +1,188 @@
+import io
+import os
+import hashlib
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from requests.adapters import HTTPAdapter
+from constants import DEFAULT_PLEX_METADATA_URL
+
+try:
+    from PIL import Image
+except ImportError:  # Opcional: sin Pillow se guarda y sirve el póster original
+    Image = None
+
+logger = logging.getLogger(__name__)
+
+METADATA_URL = DEFAULT_PLEX_METADATA_URL
+# Anchos de las tarjetas del grid (1x y 2x); el navegador elige con srcset
+POSTER_WIDTHS = (300, 600)
+
+
+def poster_version(thumb):
+    """Short hash of the Plex thumb path: changes when Plex changes the poster."""
+    return hashlib.sha1(thumb.encode()).hexdigest()[:10]
+
+
+def poster_path(plex_id, thumb):
+    """Public URL of an item's poster, or ``None`` if it has none. Never includes the token."""
+    if not thumb:
+        return None
+    return f"/poster/{plex_id}?v={poster_version(thumb)}"
+
+
+class PosterCache:
+    """Fetches Plex posters once and keeps resized WebP renditions in a bounded disk LRU.
+
+    Each poster is downloaded with the server-side token, rendered at every
+    width in ``widths`` and written to ``directory`` as
+    ``<plex_id>-<version>-<width>.webp``. Hits refresh the file's mtime, and
+    when the directory grows beyond ``max_bytes`` the least recently used
+    files are deleted. Without Pillow the original image is stored instead.
+    """
+
+    def __init__(self, directory, max_bytes, token, widths=POSTER_WIDTHS, quality=80, metadata_url=METADATA_URL):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.token = token
+        # Sin Pillow no hay redimensionado: una sola copia (ancho 0) para todos los tamaños
+        self.widths = tuple(sorted(widths)) if Image else (0,)
+        self.quality = quality
+        self.metadata_url = metadata_url
+        os.makedirs(directory, exist_ok=True)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=2, pool_maxsize=8)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self._size = self._disk_usage()
+        self._size_lock = threading.Lock()
+        self._key_locks = {}
+        self._key_locks_lock = threading.Lock()
+
+    def _disk_usage(self):
+        return sum(entry.stat().st_size for entry in os.scandir(self.directory) if entry.is_file())
+
+    def pick_width(self, requested):
+        """Smallest rendition at least ``requested`` pixels wide (the largest if none is)."""
+        for width in self.widths:
+            if width >= requested:
+                return width
+        return self.widths[-1]
+
+    @property
+    def mimetype(self):
+        return "image/webp" if Image else "image/jpeg"
+
+    def _file(self, plex_id, version, width):
+        ext = "webp" if Image else "jpg"
+        safe_id = "".join(c for c in plex_id if c.isalnum())
+        return os.path.join(self.directory, f"{safe_id}-{version}-{width}.{ext}")
+
+    def source_url(self, thumb):
+        if thumb.startswith("http"):
+            return thumb
+        return f"{self.metadata_url}{thumb}?X-Plex-Token={self.token}"
+
+    def _render(self, data):
+        """``{width: bytes}`` for every rendition of the downloaded image."""
+        if Image is None:
+            return {0: data}
+        renditions = {}
+        with Image.open(io.BytesIO(data)) as original:
+            original = original.convert("RGB")
+            for width in self.widths:
+                img = original
+                if original.width > width:
+                    img = original.resize((width, round(original.height * width / original.width)), Image.LANCZOS)
+                buf = io.BytesIO()
+                img.save(buf, "WEBP", quality=self.quality, method=4)
+                renditions[width] = buf.getvalue()
+        return renditions
+
+    def _write(self, path, data):
+        tmp = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+        with self._size_lock:
+            self._size += len(data)
+
+    def _lock_for(self, key):
+        with self._key_locks_lock:
+            return self._key_locks.setdefault(key, threading.Lock())
+
+    def cached(self, plex_id, version, width):
+        """Path of the rendition if it is already on disk, else ``None``."""
+        path = self._file(plex_id, version, self.pick_width(width))
+        return path if self._touch(path) else None
+
+    def get(self, plex_id, thumb, width):
+        """Returns the path of the rendition, downloading the poster on a miss. ``None`` if unavailable."""
+        version = poster_version(thumb)
+        path = self._file(plex_id, version, self.pick_width(width))
+        if self._touch(path):
+            return path
+
+        key = f"{plex_id}-{version}"
+        with self._lock_for(key):
+            if self._touch(path):
+                return path  # Otra petición lo acaba de descargar
+            try:
+                resp = self.session.get(self.source_url(thumb), timeout=15)
+                resp.raise_for_status()
+                for w, data in self._render(resp.content).items():
+                    self._write(self._file(plex_id, version, w), data)
+            except Exception as e:
+                logger.warning(f"No se pudo obtener el póster de {plex_id}: {e}")
+                return None
+            finally:
+                with self._key_locks_lock:
+                    self._key_locks.pop(key, None)
+        self._evict()
+        return path
+
+    @staticmethod
+    def _touch(path):
+        """Marks ``path`` as recently used. Returns ``False`` if it is not cached."""
+        try:
+            os.utime(path)
+            return True
+        except FileNotFoundError:
+            return False
+
+    def _evict(self):
+        if self._size <= self.max_bytes:
+            return
+        with self._size_lock:
+            # Otros workers comparten el directorio: se recalcula desde disco
+            entries = sorted(
+                (e for e in os.scandir(self.directory) if e.is_file() and not e.name.endswith(".tmp")),
+                key=lambda e: e.stat().st_mtime
+            )
+            total = sum(e.stat().st_size for e in entries)
+            target = self.max_bytes * 0.9
+            for entry in entries:
+                if total <= target:
+                    break
+                try:
+                    size = entry.stat().st_size
+                    os.remove(entry.path)
+                    total -= size
+                except FileNotFoundError:
+                    pass
+            self._size = total
+
+    def prefetch(self, items, workers=4):
+        """Downloads the posters of ``items`` (dicts with ``plex_id`` and ``thumb``) in the background."""
+        pending = [i for i in items if i.get("thumb")]
+        if not pending:
+            return
+
+        def run():
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                for item in pending:
+                    pool.submit(self.get, item["plex_id"], item["thumb"], self.widths[0])
+            logger.info(f"Pósters precargados: {len(pending)}")
+
+        threading.Thread(target=run, name="poster-prefetch", daemon=True).start()
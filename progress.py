@@ -0,0 +1,144 @@
+import json
+import time
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+PROGRESS_ID = "progress"
+
+
+class SyncProgress:
+    """Publishes per-stage progress of the running sync.
+
+    Progress is written to a single document (``doc_id``, one per tenant) in
+    ``collection`` so any worker can stream it, throttled to one write every
+    ``min_interval`` seconds except on stage changes and completion.
+    Listeners in the process that runs the sync are woken up directly. In
+    any other process a single poller thread reads the document every
+    ``poll_interval`` seconds while someone is listening, and wakes every
+    stream of that process, so open tabs do not multiply the Mongo reads.
+    """
+
+    def __init__(self, collection, min_interval=1.0, doc_id=PROGRESS_ID, poll_interval=1.0):
+        self.collection = collection
+        self.doc_id = doc_id
+        self.min_interval = min_interval
+        self.poll_interval = poll_interval
+        self._state = None
+        self._local_run = False
+        self._written_at = 0
+        self._listeners = 0
+        self._poller = None
+        self._cond = threading.Condition()
+
+    def _publish(self, state, force=False):
+        with self._cond:
+            previous = self._state
+            self._state = state
+            # Mientras la sincronización corra en este proceso, su estado manda sobre el de Mongo
+            self._local_run = not state.get("finished")
+            self._cond.notify_all()
+        stage_changed = not previous or previous.get("stage") != state.get("stage")
+        now = time.monotonic()
+        if force or stage_changed or now - self._written_at >= self.min_interval:
+            self._written_at = now
+            try:
+                self.collection.update_one({"id": self.doc_id}, {"$set": state}, upsert=True)
+            except Exception as e:
+                logger.warning(f"No se pudo guardar el progreso de la sincronización: {e}")
+
+    def update(self, run_id, stage, done=None, total=None):
+        """Records that ``run_id`` is in ``stage`` (optionally ``done`` of ``total`` items)."""
+        self._publish({
+            "run_id": run_id,
+            "stage": stage,
+            "done": done,
+            "total": total,
+            "finished": False,
+            "updated_at": time.time()
+        })
+
+    def finish(self, run_id, status, error=None):
+        self._publish({
+            "run_id": run_id,
+            "stage": "finished",
+            "status": status,
+            "error": error,
+            "done": None,
+            "total": None,
+            "finished": True,
+            "updated_at": time.time()
+        }, force=True)
+
+    def _poll(self):
+        """Single reader of the progress document for every stream of this process."""
+        while True:
+            with self._cond:
+                if not self._listeners:
+                    self._poller = None
+                    if not self._local_run:
+                        self._state = None  # Sin nadie escuchando deja de estar al día
+                    return
+            try:
+                doc = self.collection.find_one({"id": self.doc_id}, {"_id": 0, "id": 0})
+            except Exception as e:
+                logger.warning(f"No se pudo leer el progreso de la sincronización: {e}")
+                doc = None
+            with self._cond:
+                if doc and not self._local_run and doc != self._state:
+                    self._state = doc
+                    self._cond.notify_all()
+            time.sleep(self.poll_interval)
+
+    def _subscribe(self):
+        with self._cond:
+            self._listeners += 1
+            if self._poller is None:
+                self._poller = threading.Thread(target=self._poll, name=f"{self.doc_id}-poller", daemon=True)
+                self._poller.start()
+
+    def _unsubscribe(self):
+        with self._cond:
+            self._listeners -= 1
+
+    def _payload(self, run_id):
+        state = self._state or {}
+        if state.get("run_id") != run_id:
+            # Todavía corre la sincronización anterior; la nuestra va a continuación
+            state = {"run_id": run_id, "stage": "queued", "finished": False}
+        return {k: state.get(k) for k in ("run_id", "stage", "done", "total", "status", "error")}, state.get("finished")
+
+    def stream(self, run_id, max_seconds=50, keepalive=15):
+        """Server-Sent Events for ``run_id`` until it finishes (or ``max_seconds`` pass).
+
+        Every stream holds a web thread, so it is short: when it ends early
+        the browser's ``EventSource`` reconnects (``retry``) and resumes.
+        """
+        deadline = time.monotonic() + max_seconds
+        last = None
+        yield "retry: 3000\n\n"
+        self._subscribe()
+        try:
+            with self._cond:
+                if self._state is None:
+                    # Primera lectura del poller recién arrancado
+                    self._cond.wait(self.poll_interval)
+            while True:
+                with self._cond:
+                    payload, finished = self._payload(run_id)
+                    if payload == last:
+                        self._cond.wait(max(0, min(keepalive, deadline - time.monotonic())))
+                        payload, finished = self._payload(run_id)
+                if payload != last:
+                    last = payload
+                    event = "done" if finished else "progress"
+                    yield f"event: {event}\ndata: {json.dumps(payload)}\n\n"
+                    if finished:
+                        return
+                elif time.monotonic() >= deadline:
+                    return
+                else:
+                    yield ": keep-alive\n\n"
+        finally:
+            self._unsubscribe()
@@ -0,0 +1,123 @@
+import gzip
+import json
+import time
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from flask import Response
+from pymongo import ReturnDocument
+
+try:
+    import brotli
+except ImportError:  # Opcional: sin brotli se sirve gzip
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+GENERATION_ID = "generation"
+MIN_COMPRESS_BYTES = 512
+
+
+class CachedResponse:
+    """A JSON payload serialized once, with its compressed variants and ETag."""
+
+    def __init__(self, payload, generation):
+        self.body = json.dumps(payload, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        self.etag = f"g{generation}-{hashlib.sha1(self.body).hexdigest()[:16]}"
+        self.variants = {"identity": self.body}
+        if len(self.body) >= MIN_COMPRESS_BYTES:
+            self.variants["gzip"] = gzip.compress(self.body, compresslevel=6)
+            if brotli:
+                self.variants["br"] = brotli.compress(self.body, quality=5)
+
+
+class ResponseCache:
+    """Per-worker cache of read endpoint responses, versioned by a sync generation.
+
+    The generation lives in ``status_collection`` and is bumped whenever the
+    watchlist data changes (end of a sync, owner updates). A worker re-reads it
+    at most every ``poll_interval`` seconds, so warm reads are answered from
+    memory; a bump made by this same worker is seen immediately.
+    """
+
+    def __init__(self, status_collection, poll_interval=2, max_entries=256):
+        self.status_collection = status_collection
+        self.poll_interval = poll_interval
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._generation = None
+        self._checked_at = 0
+        self._lock = threading.Lock()
+
+    def generation(self):
+        now = time.monotonic()
+        if self._generation is None or now - self._checked_at >= self.poll_interval:
+            try:
+                doc = self.status_collection.find_one({"id": GENERATION_ID})
+                self._set_generation((doc or {}).get("value", 0))
+            except Exception as e:
+                logger.warning(f"No se pudo leer la generación de datos: {e}")
+                if self._generation is None:
+                    return 0
+            self._checked_at = now
+        return self._generation
+
+    def _set_generation(self, value):
+        with self._lock:
+            if value != self._generation:
+                self._entries.clear()
+                self._generation = value
+
+    def bump(self):
+        """Marks the data as changed so every worker drops its cached responses."""
+        doc = self.status_collection.find_one_and_update(
+            {"id": GENERATION_ID},
+            {"$inc": {"value": 1}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+        self._set_generation(doc["value"])
+        self._checked_at = time.monotonic()
+
+    def _get_entry(self, key, build):
+        generation = self.generation()
+        with self._lock:
+            entry = self._entries.get((generation, key))
+            if entry:
+                self._entries.move_to_end((generation, key))
+                return entry
+
+        entry = CachedResponse(build(), generation)
+        with self._lock:
+            if generation == self._generation:
+                self._entries[(generation, key)] = entry
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+        return entry
+
+    def respond(self, request, build):
+        """Serves ``build()`` for this request path, from memory when possible.
+
+        Answers 304 when the browser already holds the current representation.
+        """
+        entry = self._get_entry(request.full_path, build)
+
+        accepted = request.headers.get("Accept-Encoding", "")
+        encoding = "identity"
+        if "br" in entry.variants and "br" in accepted:
+            encoding = "br"
+        elif "gzip" in entry.variants and "gzip" in accepted:
+            encoding = "gzip"
+        etag = entry.etag if encoding == "identity" else f"{entry.etag}-{encoding}"
+
+        headers = {"Vary": "Accept-Encoding", "Cache-Control": "no-cache"}
+        if_none_match = request.headers.get("If-None-Match", "")
+        if f'"{etag}"' in if_none_match or if_none_match.strip() == "*":
+            resp = Response(status=304, headers=headers)
+        else:
+            resp = Response(entry.variants[encoding], mimetype="application/json", headers=headers)
+            if encoding != "identity":
+                resp.headers["Content-Encoding"] = encoding
+        resp.set_etag(etag)
+        return resp
@@ -0,0 +1,354 @@
+import time
+import hashlib
+import logging
+import threading
+import functools
+import urllib.parse
+from plex_api import PlexAPI, ServerCache, WATCHLIST_FIELDS
+from matcher import LibraryMatcher
+from fa_scraper import FACache, FAClient
+from tmdb import TMDBCache, TMDBClient, external_ids
+from library_index import LibrarySnapshot
+from watchlist_store import load_previous, save_watchlist
+from response_cache import ResponseCache
+from sync_lock import SyncCoordinator
+from progress import SyncProgress
+from notifier import TelegramOutbox
+from posters import PosterCache, poster_path
+from metrics import RunMetrics, MetricsStore
+from database import get_db
+from config import (
+    TENANTS, TMDB_API_KEY, TELEGRAM_BOT_TOKEN, PLEX_POOL_SIZE, PLEX_RETRIES, WATCHLIST_FULL_CHECK_HOURS,
+    SYNC_MIN_INTERVAL_MINUTES, PLEX_SERVER_CACHE_HOURS, LIBRARY_FULL_SYNC_HOURS, LIBRARY_REUSE_SECONDS,
+    TMDB_CACHE_TTL_HOURS, TMDB_NEGATIVE_TTL_HOURS, TMDB_REFRESH_PER_RUN, TMDB_WORKERS, TMDB_RATE_LIMIT,
+    FILMAFFINITY_ENABLED, FILMAFFINITY_POOL_SIZE, FILMAFFINITY_MAX_PER_RUN, FILMAFFINITY_CACHE_TTL_HOURS,
+    POSTER_CACHE_DIR, POSTER_CACHE_MB, TELEGRAM_BATCH_SIZE, TELEGRAM_MESSAGES_PER_MINUTE, SYNC_WORKERS,
+    EMBEDDED_WORKER, PLEX_DISCOVER_URL, PLEX_TV_URL, PLEX_METADATA_URL, TMDB_API_URL
+)
+
+logger = logging.getLogger(__name__)
+
+db = get_db()
+collection = db['watchlist'] # Particionada por tenant_id
+status_collection = db['sync_status'] # Nueva colección para el estado del servidor
+# Dirección, token y secciones del servidor (evita redescubrirlo en cada sincronización)
+server_cache = ServerCache(db['plex_servers'], ttl=PLEX_SERVER_CACHE_HOURS * 3600)
+# Copia de las librerías por servidor, compartida por los tenants que usan el mismo
+library_snapshot = LibrarySnapshot(
+    db['server_items'],
+    db['library_sections'],
+    full_every=LIBRARY_FULL_SYNC_HOURS * 3600,
+    min_refresh_interval=LIBRARY_REUSE_SECONDS
+)
+# Progreso de la sincronización en curso de cada tenant, visible desde cualquier worker
+sync_progress = {t.id: SyncProgress(status_collection, doc_id=f"progress:{t.id}") for t in TENANTS}
+# Historial (colección limitada) y totales de métricas por sincronización
+metrics_store = MetricsStore(db, totals_collection=status_collection)
+# Respuestas de lectura cacheadas en memoria hasta que cambien los datos
+response_cache = ResponseCache(status_collection)
+# Precarga de pósters: solo si la web sirve desde este mismo disco (worker embebido);
+# un worker aparte llenaría su propio disco y la web volvería a descargarlos
+poster_cache = None
+if EMBEDDED_WORKER:
+    poster_cache = PosterCache(POSTER_CACHE_DIR, POSTER_CACHE_MB * 1024 * 1024, TENANTS[0].plex_token, metadata_url=PLEX_METADATA_URL)
+fa_cache = FACache(db['filmaffinity_cache'], ttl=FILMAFFINITY_CACHE_TTL_HOURS * 3600)
+# Avisos de novedades pendientes de enviar a Telegram, al chat de cada tenant (se despachan fuera de la sincronización)
+telegram_outboxes = {
+    t.id: TelegramOutbox(
+        db['telegram_outbox'],
+        TELEGRAM_BOT_TOKEN,
+        t.telegram_chat_id,
+        t.id,
+        batch_size=TELEGRAM_BATCH_SIZE,
+        per_minute=TELEGRAM_MESSAGES_PER_MINUTE,
+        # Envíos, reintentos y descartes en /api/metrics (telegram_sent, telegram_failed...)
+        on_dispatch=lambda stats: metrics_store.add_counters(stats, prefix="telegram_")
+    )
+    for t in TENANTS
+}
+# Compartida por todos los tenants: la nota de un título no depende de quién lo pida
+tmdb_cache = TMDBCache(
+    db['tmdb_cache'],
+    ttl=TMDB_CACHE_TTL_HOURS * 3600,
+    negative_ttl=TMDB_NEGATIVE_TTL_HOURS * 3600
+)
+
+def server_snapshot(plex, server_name, run_metrics):
+    """Elementos de un servidor para el cruce y su huella (``[], None`` si no es accesible)."""
+    libraries = plex.get_server_libraries(server_name)
+    if not libraries:
+        logger.warning(f"No se encontró el servidor '{server_name}' o no es accesible.")
+        return [], None
+    server_items, stats, signature = library_snapshot.refresh(plex, libraries[0]["server_id"], libraries)
+    if plex.libraries_cached and stats["section_errors"] == len(libraries):
+        # La dirección guardada ya no responde: se redescubre el servidor y se reintenta
+        logger.warning(f"El servidor '{server_name}' no responde en la dirección cacheada; redescubriendo...")
+        server_cache.invalidate(ServerCache.make_key(plex.token, server_name))
+        rediscovered = plex.get_server_libraries(server_name, refresh=True)
+        if rediscovered:
+            libraries = rediscovered
+            server_items, stats, signature = library_snapshot.refresh(plex, libraries[0]["server_id"], libraries)
+    if libraries[0]["server_id"] != server_name:
+        # Copia de antes de identificar los servidores por clientIdentifier (guardada por nombre)
+        library_snapshot.forget(server_name)
+    run_metrics.count("server_cache_hits", int(plex.libraries_cached))
+    for name, value in stats.items():
+        run_metrics.count(f"library_{name}", value)
+    return server_items, signature
+
+def sync_watchlist(tenant, run_id=None):
+    """Tarea en segundo plano que sincroniza con MongoDB la watchlist de un tenant. Resistente a fallos de conexión.
+
+    No llamar directamente: pasa por ``sync_coordinators`` para que nunca haya dos a la vez del mismo tenant.
+    """
+    logger.info(f"Iniciando sincronización resiliente de {tenant.id} ({run_id})...")
+    progress = sync_progress[tenant.id]
+    telegram_outbox = telegram_outboxes[tenant.id]
+    status_filter = {"id": "last_sync", "tenant_id": tenant.id}
+    servers_label = ", ".join(tenant.servers)
+    progress.update(run_id, "starting")
+    run_metrics = RunMetrics(run_id)
+    outcome = "aborted"
+    plex = None
+    try:
+        plex = PlexAPI(
+            tenant.plex_token,
+            pool_size=PLEX_POOL_SIZE,
+            retries=PLEX_RETRIES,
+            discover_url=PLEX_DISCOVER_URL,
+            plex_tv_url=PLEX_TV_URL,
+            server_cache=server_cache
+        )
+        
+        # 0. Obtener estado anterior para detectar novedades y calcular los cambios a guardar
+        run_metrics.stage("load_previous")
+        old_docs = {}
+        try:
+            old_docs = load_previous(collection, tenant.id)
+        except Exception as e:
+            logger.error(f"Error leyendo estado anterior de Mongo: {e}")
+        last_sync = status_collection.find_one(status_filter) or {}
+        # Solo se confía en la huella si los elementos guardados traen los datos originales de Plex
+        known_fingerprint = None
+        if (old_docs and all("source" in doc for doc in old_docs.values())
+                and time.time() - last_sync.get("watchlist_full_at", 0) < WATCHLIST_FULL_CHECK_HOURS * 3600):
+            known_fingerprint = last_sync.get("watchlist_fingerprint")
+        
+        # 1. Obtener Watchlist de Plex (Esto es vital, si falla aquí paramos)
+        run_metrics.stage("watchlist")
+        watchlist_unchanged = False
+        try:
+            watchlist_raw = plex.get_watchlist(known_fingerprint=known_fingerprint)
+            if watchlist_raw is None:
+                # Misma huella que la última vez: se reutiliza la copia guardada
+                watchlist_unchanged = True
+                watchlist_raw = [doc["source"] for doc in sorted(old_docs.values(), key=lambda d: d.get("watchlist_order", 0))]
+                run_metrics.count("watchlist_unchanged")
+            if not watchlist_raw:
+                logger.warning("La Watchlist de Plex está vacía o no se pudo recuperar.")
+                progress.finish(run_id, "error", "La Watchlist de Plex está vacía o no se pudo recuperar.")
+                return
+        except Exception as e:
+            logger.error(f"Error crítico recuperando Watchlist: {e}")
+            progress.finish(run_id, "error", str(e))
+            return
+        progress.update(run_id, "watchlist", len(watchlist_raw), len(watchlist_raw))
+        run_metrics.count("watchlist_items", len(watchlist_raw))
+
+        watchlist_final = []
+        
+        # 2. Obtener librerías de los servidores del tenant (Si falla, continuamos con on_server=False)
+        # Solo se descargan las novedades; el resto sale de la copia guardada en Mongo
+        run_metrics.stage("libraries")
+        server_items = []
+        signatures = []
+        progress.update(run_id, "libraries", 0, len(tenant.servers))
+        for idx, server_name in enumerate(tenant.servers):
+            try:
+                items, signature = server_snapshot(plex, server_name, run_metrics)
+                server_items.extend(items)
+                signatures.append(signature)
+            except Exception as e:
+                signatures.append(None)
+                logger.error(f"Error conectando con el servidor Plex '{server_name}' para el cruce: {e}")
+            progress.update(run_id, "libraries", idx + 1, len(tenant.servers))
+        run_metrics.count("library_items", len(server_items))
+        # Sin la huella de todos los servidores no se puede asegurar que el cruce no cambie
+        library_signature = None
+        if signatures and all(signatures):
+            library_signature = hashlib.sha1("|".join(signatures).encode()).hexdigest()
+
+        if watchlist_unchanged and library_signature and library_signature == last_sync.get("library_signature"):
+            # Ni la watchlist ni la librería han cambiado: el resultado sería idéntico al guardado
+            status_collection.update_one(
+                status_filter,
+                {"$set": {"status": "success", "timestamp": int(time.time()), "server": servers_label, "run_id": run_id}},
+                upsert=True
+            )
+            response_cache.bump()
+            run_metrics.count("short_circuit")
+            outcome = "success"
+            progress.finish(run_id, "success")
+            logger.info("Sincronización finalizada: sin cambios en la watchlist ni en la librería.")
+            return
+
+        # 3. Procesar y Cruzar (Independiente de si el servidor falló)
+        run_metrics.stage("matching")
+        matcher = LibraryMatcher(server_items)
+        tmdb_lookups = []
+        newly_available = []
+        for idx, item in enumerate(watchlist_raw):
+            plex_id = item.get("ratingKey")
+            title = item.get("title")
+
+            # (Keeping the indices for sorting: 0 is the newest in Watchlist)
+            watchlist_order = idx 
+            
+            orig = item.get("originalTitle")
+            year = item.get("year")
+            type_ = "Película" if item.get("type") == "movie" else "Serie"
+            thumb = item.get("thumb")
+
+            # Verificar disponibilidad (Prioridad: GUID -> Título+Año)
+            on_server, found_in_libs, added_at = matcher.match(item)
+            progress.update(run_id, "matching", idx + 1, len(watchlist_raw))
+            
+            # La nota de TMDB se resuelve después, en paralelo (paso 4): por los ids de Plex
+            # (o el tmdb_id de una sincronización anterior) y solo sin ellos por título
+            search_type = "movie" if item.get("type") == "movie" else "tv"
+            known_tmdb_id = old_docs.get(plex_id, {}).get("tmdb_id")
+            tmdb_lookups.append((search_type, title, orig, year, external_ids(item.get("Guid"), known_tmdb_id)))
+
+            new_item = {
+                "plex_id": plex_id,
+                "title": title,
+                "orig": orig,
+                "year": year,
+                "type": type_,
+                "image": poster_path(plex_id, thumb),
+                "thumb": thumb,
+                "url": f"https://www.filmaffinity.com/es/search.php?stext={urllib.parse.quote(title or '')}",
+                "on_server": on_server,
+                "libraries": found_in_libs,
+                "score": None,
+                "tmdb_id": known_tmdb_id,
+                "fa_score": None,
+                "added_at": added_at,
+                "watchlist_order": watchlist_order,
+                "source": {k: item[k] for k in WATCHLIST_FIELDS if k in item}
+            }
+            watchlist_final.append(new_item)
+
+            # 5. Detectar Novedad para Telegram (se encola antes de guardar, ver paso 6)
+            was_on_server = old_docs.get(plex_id, {}).get("on_server", False)
+            if on_server and not was_on_server:
+                newly_available.append(new_item)
+
+        # 4. Obtener notas de TMDB (Siempre se intenta, haya servidor o no)
+        run_metrics.stage("tmdb")
+        tmdb = TMDBClient(
+            TMDB_API_KEY,
+            cache=tmdb_cache,
+            refresh_limit=TMDB_REFRESH_PER_RUN,
+            workers=TMDB_WORKERS,
+            rate_limit=TMDB_RATE_LIMIT,
+            api_url=TMDB_API_URL
+        )
+        progress.update(run_id, "tmdb")
+        scores = tmdb.resolve(
+            tmdb_lookups,
+            on_progress=lambda done, total: progress.update(run_id, "tmdb", done, total)
+        )
+        for new_item, (score, tmdb_id) in zip(watchlist_final, scores):
+            new_item["score"] = score
+            new_item["tmdb_id"] = tmdb_id or new_item["tmdb_id"]
+        for name, value in tmdb.stats.items():
+            run_metrics.count(f"tmdb_{name}", value)
+
+        # 5b. Notas y fichas de FilmAffinity (opcional, con navegador y caché propia)
+        if FILMAFFINITY_ENABLED:
+            run_metrics.stage("filmaffinity")
+            progress.update(run_id, "filmaffinity")
+            fa = FAClient(fa_cache, pool_size=FILMAFFINITY_POOL_SIZE, max_lookups=FILMAFFINITY_MAX_PER_RUN)
+            fa_results = fa.get_scores(
+                [(i["title"], i["orig"], i["year"]) for i in watchlist_final],
+                on_progress=lambda done, total: progress.update(run_id, "filmaffinity", done, total)
+            )
+            for new_item, (fa_score, fa_url) in zip(watchlist_final, fa_results):
+                new_item["fa_score"] = fa_score
+                if fa_url:
+                    new_item["url"] = fa_url
+            for name, value in fa.stats.items():
+                run_metrics.count(f"filmaffinity_{name}", value)
+
+        # 6. Guardar en MongoDB (solo los cambios; los dueños nunca se tocan)
+        if watchlist_final:
+            progress.update(run_id, "saving")
+            run_metrics.stage("saving")
+            # Encolar antes de guardar: si el guardado falla, la próxima ejecución vuelve a
+            # detectar la novedad y el outbox descarta el duplicado
+            run_metrics.count("telegram_queued", telegram_outbox.enqueue(newly_available))
+            changes = save_watchlist(collection, watchlist_final, old_docs, tenant.id)
+            run_metrics.count("mongo_write_ops", changes)
+            # Guardar estado de éxito (con las huellas para detectar la próxima vez que nada ha cambiado)
+            status = {
+                "status": "success",
+                "timestamp": int(time.time()),
+                "server": servers_label,
+                "run_id": run_id,
+                "watchlist_fingerprint": plex.watchlist_fingerprint,
+                "library_signature": library_signature
+            }
+            if not watchlist_unchanged:
+                status["watchlist_full_at"] = int(time.time())
+            status_collection.update_one(status_filter, {"$set": status}, upsert=True)
+            response_cache.bump()
+            outcome = "success"
+            progress.finish(run_id, "success")
+            telegram_outbox.dispatch_async()
+            # Precargar los pósters nuevos o cambiados para que la primera visita ya los tenga
+            if poster_cache:
+                poster_cache.prefetch([
+                    i for i in watchlist_final if i["image"] != old_docs.get(i["plex_id"], {}).get("image")
+                ])
+            logger.info(f"Sincronización de {tenant.id} finalizada. {len(watchlist_final)} elementos, {changes} cambios. TMDB: {tmdb.stats}")
+            logger.info(f"Peticiones Plex: {plex.stats.summary()}")
+        
+    except Exception as e:
+        logger.error(f"Error general en el proceso de sincronización: {e}")
+        # Guardar estado de error
+        status_collection.update_one(
+            status_filter,
+            {"$set": {"status": "error", "error": str(e), "timestamp": int(time.time()), "server": servers_label, "run_id": run_id}},
+            upsert=True
+        )
+        response_cache.bump()
+        outcome = "error"
+        progress.finish(run_id, "error", str(e))
+    finally:
+        metrics_store.record(run_metrics, outcome, plex.stats.snapshot() if plex else None, tenant_id=tenant.id)
+
+# Una sola sincronización a la vez por tenant en todo el despliegue (workers + planificador),
+# y como mucho SYNC_WORKERS de tenants distintos a la vez en cada proceso
+sync_slots = threading.BoundedSemaphore(SYNC_WORKERS)
+sync_coordinators = {
+    t.id: SyncCoordinator(db['sync_locks'], functools.partial(sync_watchlist, t), lease_id=f"sync:{t.id}", slots=sync_slots)
+    for t in TENANTS
+}
+
+def scheduled_sync(tenant_id):
+    """Tick horario: no hace nada si otro worker ya sincronizó (o está sincronizando) hace poco."""
+    run_id, state = sync_coordinators[tenant_id].trigger(min_interval=SYNC_MIN_INTERVAL_MINUTES * 60)
+    logger.info(f"Sincronización programada de {tenant_id}: {state} ({run_id})")
+
+def dispatch_telegram():
+    for outbox in telegram_outboxes.values():
+        outbox.dispatch()
+
+def poll_requests():
+    """Arranca las sincronizaciones pedidas desde la web (``/api/sync``)."""
+    # Una sola consulta para todos los tenants; solo se atiende a los que tienen petición
+    requested = SyncCoordinator.requested(db['sync_locks'], [c.lease_id for c in sync_coordinators.values()])
+    for coordinator in sync_coordinators.values():
+        if coordinator.lease_id in requested:
+            coordinator.poll()
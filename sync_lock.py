@@ -0,0 +1,209 @@
+import os
+import time
+import uuid
+import socket
+import logging
+import threading
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+logger = logging.getLogger(__name__)
+
+LEASE_ID = "sync"
+
+
+def new_run_id():
+    return uuid.uuid4().hex[:12]
+
+
+class SyncCoordinator:
+    """Runs ``run_sync(run_id)`` at most once at a time across every process.
+
+    A lease document in ``collection`` names the process currently syncing;
+    the holder extends it with a heartbeat and it expires after ``ttl``
+    seconds if that process dies. Triggers arriving while a sync is running
+    are coalesced into a single follow-up run, executed by the holder before
+    it releases the lease.
+
+    Each coordinator owns one lease (``lease_id``, e.g. one per tenant). An
+    optional ``slots`` semaphore shared by several coordinators bounds how
+    many of their runs execute at once in this process.
+
+    A process that does not sync itself (the web, without ``run_sync``)
+    uses ``request``: it leaves the run id on the lease, and the worker's
+    ``poll`` starts it.
+    """
+
+    def __init__(self, collection, run_sync=None, ttl=120, lease_id=LEASE_ID, slots=None):
+        self.collection = collection
+        self.lease_id = lease_id
+        # Semáforo compartido entre coordinadores: limita cuántas sincronizaciones corren a la vez
+        self.slots = slots
+        self.run_sync = run_sync
+        self.ttl = ttl
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+
+    def _try_acquire(self, run_id, min_interval):
+        now = time.time()
+        conditions = [{"$or": [{"expires_at": {"$lt": now}}, {"expires_at": {"$exists": False}}]}]
+        if min_interval:
+            conditions.append({"$or": [
+                {"last_finished_at": {"$lt": now - min_interval}},
+                {"last_finished_at": {"$exists": False}}
+            ]})
+        query = {"_id": self.lease_id, "$and": conditions}
+        try:
+            doc = self.collection.find_one_and_update(
+                query,
+                {"$set": {
+                    "owner": self.owner,
+                    "run_id": run_id,
+                    "pending_run_id": None,
+                    "started_at": now,
+                    "expires_at": now + self.ttl
+                }},
+                upsert=True,
+                return_document=ReturnDocument.AFTER
+            )
+        except DuplicateKeyError:
+            # El documento existe pero no cumple el filtro: hay otra sincronización en marcha
+            return False
+        return bool(doc and doc.get("owner") == self.owner and doc.get("run_id") == run_id)
+
+    def _queue_follow_up(self):
+        """Marks a follow-up run on the active lease. Returns its id, or None if the lease was released."""
+        self.collection.update_one(
+            {"_id": self.lease_id, "owner": {"$ne": None}, "pending_run_id": None, "expires_at": {"$gte": time.time()}},
+            {"$set": {"pending_run_id": new_run_id()}}
+        )
+        doc = self.collection.find_one({"_id": self.lease_id, "owner": {"$ne": None}})
+        return doc.get("pending_run_id") if doc else None
+
+    def _heartbeat(self, stop):
+        while not stop.wait(self.ttl / 3):
+            try:
+                self.collection.update_one(
+                    {"_id": self.lease_id, "owner": self.owner},
+                    {"$set": {"expires_at": time.time() + self.ttl}}
+                )
+            except Exception as e:
+                logger.warning(f"No se pudo renovar el lease de sincronización: {e}")
+
+    def _next_run(self):
+        """Takes the queued follow-up or releases the lease. Returns the next run id or None."""
+        while True:
+            doc = self.collection.find_one({"_id": self.lease_id, "owner": self.owner}) or {}
+            pending = doc.get("pending_run_id")
+            now = time.time()
+            if pending:
+                result = self.collection.update_one(
+                    {"_id": self.lease_id, "owner": self.owner, "pending_run_id": pending},
+                    {"$set": {"run_id": pending, "pending_run_id": None, "started_at": now, "expires_at": now + self.ttl}}
+                )
+                if result.modified_count:
+                    return pending
+            else:
+                result = self.collection.update_one(
+                    {"_id": self.lease_id, "owner": self.owner, "pending_run_id": None},
+                    {"$set": {"owner": None, "expires_at": 0, "last_finished_at": now, "last_run_id": doc.get("run_id")}}
+                )
+                if result.modified_count or not doc:
+                    return None
+
+    def _run_loop(self, run_id):
+        stop = threading.Event()
+        threading.Thread(target=self._heartbeat, args=(stop,), daemon=True).start()
+        try:
+            while run_id:
+                logger.info(f"Sincronización {run_id} iniciada por {self.owner}")
+                try:
+                    if self.slots:
+                        with self.slots:
+                            self.run_sync(run_id)
+                    else:
+                        self.run_sync(run_id)
+                except Exception as e:
+                    logger.error(f"Sincronización {run_id} fallida: {e}")
+                run_id = self._next_run()
+        finally:
+            stop.set()
+
+    def _start(self, run_id):
+        threading.Thread(target=self._run_loop, args=(run_id,), name=f"sync-{self.lease_id}", daemon=True).start()
+
+    def trigger(self, min_interval=0):
+        """Requests a sync. Returns ``(run_id, state)``.
+
+        ``state`` is ``"started"`` when this call launched a run in a
+        background thread, ``"queued"`` when it joined the follow-up of the
+        running sync and ``"skipped"`` when ``min_interval`` applies (the
+        scheduler passes it so a recent or ongoing sync makes its tick a no-op).
+        """
+        for _ in range(3):
+            run_id = new_run_id()
+            if self._try_acquire(run_id, min_interval):
+                self._start(run_id)
+                return run_id, "started"
+
+            lease = self.collection.find_one({"_id": self.lease_id}) or {}
+            running = lease.get("owner") and lease.get("expires_at", 0) >= time.time()
+            if min_interval:
+                return (lease.get("run_id") if running else lease.get("last_run_id")), "skipped"
+            if running:
+                pending = self._queue_follow_up()
+                if pending:
+                    return pending, "queued"
+            # El lease se liberó entre medias: se vuelve a intentar adquirirlo
+        return None, "skipped"
+
+    def request(self):
+        """Asks the worker for a sync without running it here. Returns ``(run_id, state)``.
+
+        ``state`` is ``"queued"`` when it joined the follow-up of the running
+        sync and ``"requested"`` when the run waits for the worker's ``poll``.
+        Repeated requests before the worker picks them up share one run id.
+        """
+        lease = self.collection.find_one({"_id": self.lease_id}) or {}
+        if lease.get("owner") and lease.get("expires_at", 0) >= time.time():
+            pending = self._queue_follow_up()
+            if pending:
+                return pending, "queued"
+        try:
+            self.collection.update_one(
+                {"_id": self.lease_id, "requested_run_id": None},
+                {"$set": {"requested_run_id": new_run_id(), "requested_at": time.time()}},
+                upsert=True
+            )
+        except DuplicateKeyError:
+            pass  # Ya había una petición pendiente: se comparte
+        doc = self.collection.find_one({"_id": self.lease_id}) or {}
+        return doc.get("requested_run_id"), "requested"
+
+    @staticmethod
+    def requested(collection, lease_ids):
+        """Ids among ``lease_ids`` with a run waiting for ``poll``, in a single query."""
+        query = {"_id": {"$in": list(lease_ids)}, "requested_run_id": {"$ne": None}}
+        return {doc["_id"] for doc in collection.find(query, {"_id": 1})}
+
+    def poll(self):
+        """Starts (or queues behind the running sync) the run asked for with ``request``. Returns its id or None."""
+        doc = self.collection.find_one({"_id": self.lease_id, "requested_run_id": {"$ne": None}})
+        if not doc:
+            return None
+        run_id = doc["requested_run_id"]
+        if self._try_acquire(run_id, 0):
+            state = "started"
+        else:
+            # Hay otra sincronización en marcha: la petición pasa a ser su continuación
+            result = self.collection.update_one(
+                {"_id": self.lease_id, "owner": {"$ne": None}, "pending_run_id": None, "expires_at": {"$gte": time.time()}},
+                {"$set": {"pending_run_id": run_id}}
+            )
+            if not result.modified_count:
+                return None  # Ya tiene continuación pendiente; se vuelve a mirar en la siguiente ronda
+            state = "queued"
+        self.collection.update_one({"_id": self.lease_id, "requested_run_id": run_id}, {"$set": {"requested_run_id": None}})
+        if state == "started":
+            self._start(run_id)
+        logger.info(f"Sincronización {run_id} pedida desde la web: {state}")
+        return run_id
@@ -0,0 +1,123 @@
+import re
+import hmac
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TENANT = "default"
+TENANT_ID_RE = re.compile(r"^[A-Za-z0-9_-]{1,40}$")
+MIN_ACCESS_KEY_LENGTH = 16
+
+
+class Tenant:
+    """A household: one Plex account (``plex_token``) and the servers its watchlist is checked against.
+
+    ``telegram_chat_id`` receives its announcements (the bot is shared) and
+    ``schedule_offset`` (minutes past the hour) pins when its hourly sync
+    runs; without it the syncs of all tenants are spread over the hour.
+    ``access_key`` is the secret the web uses to tell households apart.
+    """
+
+    def __init__(self, tenant_id, plex_token, servers, telegram_chat_id=None, schedule_offset=None, access_key=None):
+        self.id = tenant_id
+        self.plex_token = plex_token
+        self.servers = servers
+        self.telegram_chat_id = telegram_chat_id
+        self.schedule_offset = schedule_offset
+        self.access_key = access_key
+
+    def __repr__(self):
+        return f"Tenant({self.id!r}, servers={self.servers!r})"
+
+
+def load_tenants(raw, plex_token=None, server_name=None, telegram_chat_id=None, access_key=None):
+    """Parses the ``TENANTS`` JSON list; without it, a single ``default`` tenant from the legacy variables.
+
+    Each entry: ``{"id", "plex_token", "access_key", "servers": [...], "telegram_chat_id"?, "schedule_offset"?}``.
+    Raises ``ValueError`` on a malformed configuration.
+    """
+    if not raw:
+        return [Tenant(DEFAULT_TENANT, plex_token, [server_name] if server_name else [], telegram_chat_id,
+                       access_key=access_key)]
+
+    tenants = []
+    for entry in json.loads(raw):
+        tenant_id = entry.get("id", "")
+        if not TENANT_ID_RE.match(tenant_id):
+            raise ValueError(f"Id de tenant inválido: {tenant_id!r}")
+        if any(t.id == tenant_id for t in tenants):
+            raise ValueError(f"Id de tenant repetido: {tenant_id}")
+        if not entry.get("plex_token"):
+            raise ValueError(f"El tenant {tenant_id} no tiene plex_token")
+        access_key = entry.get("access_key") or ""
+        if len(access_key) < MIN_ACCESS_KEY_LENGTH:
+            raise ValueError(f"El tenant {tenant_id} necesita un access_key de al menos {MIN_ACCESS_KEY_LENGTH} caracteres")
+        if any(t.access_key == access_key for t in tenants):
+            raise ValueError(f"El tenant {tenant_id} repite el access_key de otro")
+        servers = entry.get("servers") or []
+        if isinstance(servers, str):
+            servers = [servers]
+        tenants.append(Tenant(
+            tenant_id,
+            entry["plex_token"],
+            servers,
+            entry.get("telegram_chat_id"),
+            entry.get("schedule_offset"),
+            access_key
+        ))
+    if not tenants:
+        raise ValueError("TENANTS no define ningún tenant")
+    return tenants
+
+
+def tenant_for_key(tenants, key):
+    """Tenant whose ``access_key`` is ``key``, or None.
+
+    Only the legacy single-household setup without ``ACCESS_KEY`` is open to
+    anyone, as it was before tenants existed.
+    """
+    if len(tenants) == 1 and not tenants[0].access_key:
+        return tenants[0]
+    if not key:
+        return None
+    for tenant in tenants:
+        if tenant.access_key and hmac.compare_digest(tenant.access_key.encode(), key.encode()):
+            return tenant
+    return None
+
+
+def schedule_offsets(tenants, period_minutes=60):
+    """Minutes past the hour at which each tenant's sync runs: explicit offsets, or spread evenly."""
+    step = period_minutes / len(tenants)
+    return {
+        t.id: (t.schedule_offset if t.schedule_offset is not None else round(i * step)) % period_minutes
+        for i, t in enumerate(tenants)
+    }
+
+
+def _drop_untenanted_indexes(collection):
+    for name, info in collection.index_information().items():
+        if name != "_id_" and info["key"][0][0] != "tenant_id":
+            collection.drop_index(name)
+            logger.info(f"Índice {collection.name}.{name} sustituido por su versión con tenant_id")
+
+
+def adopt_legacy_data(db, tenant_id=DEFAULT_TENANT):
+    """Assigns documents written before multi-tenancy to ``tenant_id``. Idempotent.
+
+    Also drops the old indexes without ``tenant_id`` (the unique ``plex_id``
+    one would otherwise stop two tenants from watchlisting the same title).
+    """
+    try:
+        for name in ("watchlist", "telegram_outbox"):
+            result = db[name].update_many({"tenant_id": {"$exists": False}}, {"$set": {"tenant_id": tenant_id}})
+            if result.modified_count:
+                logger.info(f"{result.modified_count} documentos de {name} asignados al tenant {tenant_id}")
+            _drop_untenanted_indexes(db[name])
+        db["sync_status"].update_one(
+            {"id": "last_sync", "tenant_id": {"$exists": False}},
+            {"$set": {"tenant_id": tenant_id}}
+        )
+    except Exception as e:
+        logger.warning(f"No se pudieron migrar los datos anteriores a los tenants: {e}")
@@ -0,0 +1,124 @@
+"""Parity of ``LibraryMatcher`` with the nested loop it replaced in ``sync_watchlist``."""
+import random
+
+from matcher import LibraryMatcher
+
+
+def baseline_match(item, server_items):
+    """The original O(W x S) scan, verbatim apart from returning its result."""
+    plex_id = item.get("ratingKey")
+    title = item.get("title")
+    orig = item.get("originalTitle")
+    year = item.get("year")
+
+    on_server = False
+    found_in_libs = []
+    added_at = 0
+    for s_item in server_items:
+        # 1. Match por GUID (El más preciso)
+        # Soportamos el formato moderno plex:// y el antiguo match por ratingKey
+        guid_match = (plex_id and s_item["guid"] and s_item["guid"].endswith(plex_id)) or \
+                    (item.get("guid") and s_item["guid"] == item.get("guid"))
+
+        # 2. Match por Título + Año (Fallback con verificación estricta de año)
+        title_match = False
+        year_match = False
+
+        # Falback solo si ambos años son válidos > 0
+        if not guid_match and year > 0 and s_item["year"] > 0:
+            title_match = (title and s_item["title"] == title.lower()) or \
+                         (orig and s_item["orig"] == orig.lower()) or \
+                         (title and s_item["orig"] == title.lower()) or \
+                         (orig and s_item["title"] == orig.lower())
+
+            year_match = abs(s_item["year"] - year) <= 1
+
+        if guid_match or (title_match and year_match):
+            on_server = True
+            added_at = s_item["added_at"]
+            if s_item["lib"] not in found_in_libs:
+                found_in_libs.append(s_item["lib"])
+            if guid_match: break # Match definitivo
+    return on_server, found_in_libs, added_at
+
+
+TITLES = ["Alien", "Heat", "Up", "Her", "Dune", "Ran"]
+LIBRARIES = ["Películas", "Películas 4K", "Series", "Infantil"]
+
+
+def random_key(rng):
+    # Alfabeto corto para que haya claves que son sufijo de otras
+    return "".join(rng.choice("ab1") for _ in range(rng.randint(1, 4)))
+
+
+def make_library(rng, size):
+    server_items = []
+    for _ in range(size):
+        kind = rng.random()
+        if kind < 0.7:
+            guid = f"plex://movie/{random_key(rng)}"
+        elif kind < 0.85:
+            guid = f"com.plexapp.agents.imdb://tt{rng.randint(1, 9)}?lang=es"
+        else:
+            guid = None
+        server_items.append({
+            "title": rng.choice(TITLES).lower(),
+            "orig": rng.choice(TITLES + ["", ""]).lower(),
+            "year": rng.choice([0, 1999, 2000, 2001, 2002]),
+            "guid": guid,
+            "lib": rng.choice(LIBRARIES),
+            "added_at": rng.randint(1, 10 ** 6),
+        })
+    # El mismo título en varias librerías (misma GUID, mismos datos)
+    for s_item in rng.sample(server_items, min(3, len(server_items))):
+        server_items.append(dict(s_item, lib=rng.choice(LIBRARIES), added_at=rng.randint(1, 10 ** 6)))
+    rng.shuffle(server_items)
+    return server_items
+
+
+def make_item(rng, server_items):
+    source = rng.choice(server_items) if server_items else None
+    guid = source["guid"] if source and source["guid"] and rng.random() < 0.3 else f"plex://movie/{random_key(rng)}"
+    key = random_key(rng)
+    if source and source["guid"] and rng.random() < 0.4:
+        key = source["guid"].rsplit("/", 1)[-1]
+        if rng.random() < 0.5:
+            key = key[rng.randint(0, len(key) - 1):]  # Solo un sufijo del ratingKey
+    year = rng.choice([1998, 1999, 2000, 2001, 2002, 2003, 0, None])
+    return {
+        "ratingKey": rng.choice([key, key, None]),
+        "guid": rng.choice([guid, guid, None]),
+        "title": rng.choice(TITLES + [None]),
+        "originalTitle": rng.choice([rng.choice(TITLES).upper(), None]),
+        "year": year,
+    }
+
+
+def test_matches_baseline_loop_on_generated_data():
+    rng = random.Random(20261018)
+    checked = matched = 0
+    for _ in range(300):
+        server_items = make_library(rng, rng.randint(0, 40))
+        matcher = LibraryMatcher(server_items)
+        for _ in range(20):
+            item = make_item(rng, server_items)
+            try:
+                expected = baseline_match(item, server_items)
+            except TypeError:
+                # Sin año el bucle original fallaba (None > 0) salvo que coincidiera la GUID;
+                # el matcher se queda solo con la GUID, igual que el bucle con año 0
+                expected = baseline_match(dict(item, year=0), server_items)
+            assert matcher.match(item) == expected, item
+            checked += 1
+            matched += expected[0]
+    # Los datos generados cubren tanto aciertos como fallos
+    assert 0.2 * checked < matched < 0.9 * checked
+
+
+def test_rating_key_matches_as_guid_suffix():
+    server_items = [
+        {"title": "alien", "orig": "", "year": 1979, "guid": "plex://movie/5d7768", "lib": "Películas", "added_at": 1},
+        {"title": "heat", "orig": "", "year": 1995, "guid": "plex://movie/ab7768", "lib": "Películas 4K", "added_at": 2},
+    ]
+    item = {"ratingKey": "7768", "guid": None, "title": "Otra", "year": 2000}
+    assert LibraryMatcher(server_items).match(item) == baseline_match(item, server_items) == (True, ["Películas"], 1)
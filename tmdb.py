@@ -0,0 +1,312 @@
+import time
+import logging
+import threading
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timezone
+import requests
+from requests.adapters import HTTPAdapter
+from pymongo import ASCENDING
+from constants import DEFAULT_TMDB_API_URL
+
+logger = logging.getLogger(__name__)
+
+API_URL = DEFAULT_TMDB_API_URL
+SEARCH_URL = "{api_url}/search/{search_type}?api_key={api_key}&query={query}&year={year}"
+DETAILS_URL = "{api_url}/{search_type}/{tmdb_id}?api_key={api_key}"
+FIND_URL = "{api_url}/find/{external_id}?api_key={api_key}&external_source={source}"
+# Ids externos que trae Plex en ``Guid`` (tmdb://603, imdb://tt0133093, tvdb://81189), en orden de preferencia
+ID_SOURCES = ("tmdb", "imdb", "tvdb")
+FIND_SOURCES = {"imdb": "imdb_id", "tvdb": "tvdb_id"}
+
+
+def external_ids(guids, tmdb_id=None):
+    """``{"tmdb": ..., "imdb": ..., "tvdb": ...}`` from the ``Guid`` entries of a Plex item.
+
+    ``tmdb_id`` (resolved by an earlier sync) fills in a missing TMDB id.
+    """
+    ids = {}
+    for guid in guids or []:
+        source, _, value = (guid.get("id") or "").partition("://")
+        if source in ID_SOURCES and value:
+            ids.setdefault(source, value)
+    if tmdb_id and "tmdb" not in ids:
+        ids["tmdb"] = str(tmdb_id)
+    return ids
+
+
+class TMDBCache:
+    """Mongo-backed cache of TMDB scores.
+
+    Entries are keyed by the strongest id of the item (``type|tmdb:603``,
+    ``type|imdb:tt0133093``...) or, without ids, by ``(type, query, year)``,
+    and remember the TMDB id once it is resolved. Expired entries are kept around (and still served)
+    until ``purge_after`` so they can be refreshed lazily instead of blocking
+    the sync; a TTL index removes them once they are truly abandoned.
+    """
+
+    def __init__(self, collection, ttl=7 * 24 * 3600, negative_ttl=24 * 3600, purge_after=30 * 24 * 3600):
+        self.collection = collection
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.purge_after = purge_after
+        self._indexed = False
+
+    def _ensure_index(self):
+        if self._indexed:
+            return
+        try:
+            self.collection.create_index([("purge_at", ASCENDING)], expireAfterSeconds=0)
+            self._indexed = True
+        except Exception as e:
+            logger.warning(f"No se pudo crear el índice TTL de la caché TMDB: {e}")
+
+    @staticmethod
+    def make_key(search_type, query, year):
+        return f"{search_type}|{(query or '').strip().lower()}|{year or 0}"
+
+    @staticmethod
+    def make_id_key(search_type, source, external_id):
+        return f"{search_type}|{source}:{external_id}"
+
+    @classmethod
+    def lookup_key(cls, search_type, title, orig, year, ids=None):
+        """Key of a lookup: its preferred external id if it has one, else the title search."""
+        for source in ID_SOURCES:
+            if ids and ids.get(source):
+                return cls.make_id_key(search_type, source, ids[source])
+        return cls.make_key(search_type, orig or title, year)
+
+    def get_many(self, keys):
+        """Returns ``{key: doc}`` for the cached entries among ``keys``."""
+        try:
+            return {doc["_id"]: doc for doc in self.collection.find({"_id": {"$in": list(set(keys))}})}
+        except Exception as e:
+            logger.warning(f"Error leyendo caché TMDB: {e}")
+            return {}
+
+    def put(self, key, score, tmdb_id=None):
+        """Stores a lookup result. ``score=None`` records a negative result."""
+        now = int(time.time())
+        ttl = self.ttl if score is not None else self.negative_ttl
+        doc = {
+            "score": score,
+            "tmdb_id": tmdb_id,
+            "fetched_at": now,
+            "expires_at": now + ttl,
+            # Los índices TTL de Mongo solo funcionan sobre fechas BSON
+            "purge_at": datetime.fromtimestamp(now + ttl + self.purge_after, tz=timezone.utc),
+        }
+        self._ensure_index()
+        try:
+            self.collection.update_one({"_id": key}, {"$set": doc}, upsert=True)
+        except Exception as e:
+            logger.warning(f"Error guardando caché TMDB: {e}")
+
+
+def format_score(score):
+    """Score as stored in the watchlist: a number rounded to one decimal, or None."""
+    return None if score is None else round(score, 1)
+
+
+class TokenBucket:
+    """Thread-safe token bucket: ``rate`` tokens per second, bursts up to ``capacity``."""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class TMDBClient:
+    """Looks up TMDB scores, going through an optional ``TMDBCache``.
+
+    Items with external ids are resolved by id (``/movie/{id}``, or
+    ``/find`` for IMDb and TVDB ids); the fuzzy title search is only the
+    fallback when there is no id or TMDB does not know it.
+
+    Fresh entries are answered from the cache. Stale entries are served as-is
+    and only ``refresh_limit`` of them are re-queried per client (one client is
+    created per sync run), so each run does a bounded number of HTTP requests.
+    Lookups that do need the network run on a pool of ``workers`` threads that
+    share one keep-alive session and a ``rate_limit`` requests/second bucket.
+    """
+
+    def __init__(self, api_key, cache=None, refresh_limit=25, workers=8, rate_limit=20, max_retries=3, api_url=API_URL):
+        self.api_key = api_key
+        self.api_url = api_url
+        self.cache = cache
+        self.refresh_budget = refresh_limit
+        self.workers = workers
+        self.max_retries = max_retries
+        self.bucket = TokenBucket(rate_limit)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=workers)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.stats = {"hits": 0, "stale": 0, "misses": 0, "requests": 0, "errors": 0, "throttled": 0,
+                      "by_id": 0, "by_title": 0}
+        self._lock = threading.Lock()
+
+    def _count(self, name):
+        with self._lock:
+            self.stats[name] += 1
+
+    def _get_json(self, url):
+        """GET with rate limiting and exponential backoff on 429/5xx."""
+        for attempt in range(self.max_retries + 1):
+            self.bucket.acquire()
+            self._count("requests")
+            resp = self.session.get(url, timeout=5)
+            retryable = resp.status_code == 429 or resp.status_code >= 500
+            if retryable and attempt < self.max_retries:
+                if resp.status_code == 429:
+                    self._count("throttled")
+                retry_after = resp.headers.get("Retry-After")
+                time.sleep(float(retry_after) if retry_after and retry_after.isdigit() else 0.5 * 2 ** attempt)
+                continue
+            resp.raise_for_status()
+            return resp.json()
+
+    def _search(self, search_type, query, year):
+        url = SEARCH_URL.format(api_url=self.api_url, search_type=search_type, api_key=self.api_key,
+                                query=urllib.parse.quote(query), year=year)
+        return self._get_json(url)
+
+    def _details(self, search_type, tmdb_id):
+        url = DETAILS_URL.format(api_url=self.api_url, search_type=search_type, tmdb_id=tmdb_id, api_key=self.api_key)
+        try:
+            res = self._get_json(url)
+        except requests.HTTPError as e:
+            if e.response is not None and e.response.status_code == 404:
+                return None  # Id que TMDB no conoce (o de otro tipo)
+            raise
+        return res.get("vote_average", 0), res.get("id")
+
+    def _find(self, search_type, source, external_id):
+        url = FIND_URL.format(api_url=self.api_url, external_id=urllib.parse.quote(external_id),
+                              api_key=self.api_key, source=FIND_SOURCES[source])
+        results = self._get_json(url).get(f"{search_type}_results") or []
+        if results:
+            return results[0].get("vote_average", 0), results[0].get("id")
+        return None
+
+    def fetch(self, search_type, title, orig, year, ids=None):
+        """Queries TMDB directly. Returns ``(vote_average, tmdb_id)`` or ``(None, None)``.
+
+        Tries the external ``ids`` first and searches by title only if none
+        of them resolves.
+        """
+        ids = ids or {}
+        if ids.get("tmdb"):
+            result = self._details(search_type, ids["tmdb"])
+            if result:
+                self._count("by_id")
+                return result
+        for source in FIND_SOURCES:
+            if ids.get(source):
+                result = self._find(search_type, source, ids[source])
+                if result:
+                    self._count("by_id")
+                    return result
+
+        if not (orig or title):
+            return None, None
+        self._count("by_title")
+        query = orig if orig else title
+        res = self._search(search_type, query, year)
+        if not res.get("results") and title:
+            res = self._search(search_type, title, year)
+        if res.get("results"):
+            first = res["results"][0]
+            return first.get("vote_average", 0), first.get("id")
+        return None, None
+
+    def _resolve(self, key, cached, search_type, title, orig, year, ids):
+        try:
+            score, tmdb_id = self.fetch(search_type, title, orig, year, ids)
+        except Exception as e:
+            self._count("errors")
+            logger.error(f"Error TMDB for {title}: {e}")
+            # Si falla la renovación seguimos sirviendo el valor anterior
+            return (format_score(cached.get("score")), cached.get("tmdb_id")) if cached else (None, None)
+
+        if self.cache:
+            self.cache.put(key, score, tmdb_id)
+            id_key = TMDBCache.make_id_key(search_type, "tmdb", tmdb_id)
+            if tmdb_id and key != id_key:
+                # La próxima sincronización ya llega con el id de TMDB (se guarda en la watchlist)
+                self.cache.put(id_key, score, tmdb_id)
+        return format_score(score), tmdb_id
+
+    def resolve(self, lookups, on_progress=None):
+        """Resolves ``(search_type, title, orig, year, ids)`` tuples to ``(score, tmdb_id)``.
+
+        ``ids`` are the item's external ids (see ``external_ids``), or None.
+        The result list is in the same order as ``lookups``. Cache entries are
+        read in a single query; only misses and the refresh budget hit TMDB.
+        ``on_progress(done, total)`` is called as network lookups complete.
+        """
+        results = [(None, None)] * len(lookups)
+        if not self.api_key:
+            return results
+
+        keys = [TMDBCache.lookup_key(*lookup) for lookup in lookups]
+        title_keys = [TMDBCache.make_key(t, orig or title, year) for t, title, orig, year, _ in lookups]
+        cached_docs = self.cache.get_many(keys + title_keys) if self.cache else {}
+
+        pending = {}
+        for idx, (key, title_key, lookup) in enumerate(zip(keys, title_keys, lookups)):
+            search_type, title, orig, year, ids = lookup
+            if not (orig or title or ids):
+                continue
+            if key in pending:
+                # Misma búsqueda repetida en la lista: se resuelve una sola vez
+                pending[key][0].append(idx)
+                continue
+            cached = cached_docs.get(key)
+            if cached is None and title_key in cached_docs:
+                # Nota cacheada por título (antes de resolver por id): se sirve como caducada y sin
+                # su tmdb_id, que pudo salir de la búsqueda equivocada
+                cached = dict(cached_docs[title_key], expires_at=0, tmdb_id=None)
+            if cached:
+                if cached.get("expires_at", 0) > time.time():
+                    self.stats["hits"] += 1
+                    results[idx] = (format_score(cached.get("score")), cached.get("tmdb_id"))
+                    continue
+                if self.refresh_budget <= 0:
+                    self.stats["stale"] += 1
+                    results[idx] = (format_score(cached.get("score")), cached.get("tmdb_id"))
+                    continue
+                self.refresh_budget -= 1
+            else:
+                self.stats["misses"] += 1
+            pending[key] = ([idx], cached, lookup)
+
+        if pending:
+            with ThreadPoolExecutor(max_workers=self.workers) as pool:
+                futures = {
+                    pool.submit(self._resolve, key, cached, *lookup): indexes
+                    for key, (indexes, cached, lookup) in pending.items()
+                }
+                for done, future in enumerate(as_completed(futures), 1):
+                    result = future.result()
+                    for idx in futures[future]:
+                        results[idx] = result
+                    if on_progress:
+                        on_progress(done, len(futures))
+        return results
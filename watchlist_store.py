@@ -0,0 +1,190 @@
+import json
+import time
+import base64
+import logging
+from pymongo import ASCENDING, DESCENDING, UpdateOne, DeleteOne
+from pymongo.collation import Collation
+
+logger = logging.getLogger(__name__)
+
+# Campos que solo gestiona el usuario desde la web; la sincronización nunca los escribe
+USER_FIELDS = ("owners",)
+
+# Ordenaciones disponibles en /api/watchlist: (campo, dirección). plex_id desempata en la misma
+# dirección, para que Mongo recorra los índices (campo, plex_id) al derecho o al revés sin ordenar en memoria.
+SORTS = {
+    "watchlist_newest": ("watchlist_order", ASCENDING),
+    "newest": ("year", DESCENDING),
+    "oldest": ("year", ASCENDING),
+    "rating": ("score", DESCENDING),
+    "title": ("title", ASCENDING),
+}
+TITLE_COLLATION = Collation(locale="es")
+PUBLIC_FIELDS = (
+    "plex_id", "title", "orig", "year", "type", "image", "url", "on_server",
+    "libraries", "score", "fa_score", "added_at", "owners", "watchlist_order"
+)
+RECENT_SECONDS = 7 * 24 * 60 * 60
+MAX_PAGE_SIZE = 500
+
+
+def ensure_indexes(collection):
+    """Every index starts with ``tenant_id``: each tenant's watchlist is its own partition."""
+    tenant = ("tenant_id", ASCENDING)
+    try:
+        collection.create_index([tenant, ("plex_id", ASCENDING)], unique=True)
+        # Un índice por campo de orden, solo y precedido del filtro de disponibilidad
+        for field in sorted({field for field, _ in SORTS.values()}):
+            options = {"collation": TITLE_COLLATION} if field == "title" else {}
+            collection.create_index([tenant, (field, ASCENDING), ("plex_id", ASCENDING)], **options)
+            collection.create_index([tenant, ("on_server", ASCENDING), (field, ASCENDING), ("plex_id", ASCENDING)], **options)
+        collection.create_index([tenant, ("owners", ASCENDING), ("watchlist_order", ASCENDING)])
+    except Exception as e:
+        logger.warning(f"No se pudieron crear los índices de la watchlist: {e}")
+
+
+def load_previous(collection, tenant_id):
+    """Returns ``{plex_id: doc}`` with the stored watchlist of ``tenant_id``, without user-managed fields."""
+    projection = {"_id": 0}
+    projection.update({field: 0 for field in USER_FIELDS})
+    return {doc["plex_id"]: doc for doc in collection.find({"tenant_id": tenant_id}, projection) if doc.get("plex_id")}
+
+
+def build_operations(new_items, previous, tenant_id):
+    """Diffs the freshly synced items against ``previous`` and returns the bulk operations.
+
+    Unchanged documents produce no operation, changed ones only ``$set`` the
+    fields that differ, and items that left the watchlist are deleted.
+    """
+    ops = []
+    seen = set()
+    for item in new_items:
+        plex_id = item.get("plex_id")
+        if not plex_id or plex_id in seen:
+            continue
+        seen.add(plex_id)
+        fields = {k: v for k, v in item.items() if k not in USER_FIELDS and k != "_id"}
+        fields["tenant_id"] = tenant_id
+
+        old = previous.get(plex_id)
+        if old is None:
+            ops.append(UpdateOne(
+                {"tenant_id": tenant_id, "plex_id": plex_id},
+                {"$set": fields, "$setOnInsert": {field: [] for field in USER_FIELDS}},
+                upsert=True
+            ))
+            continue
+
+        changed = {k: v for k, v in fields.items() if old.get(k) != v}
+        if changed:
+            ops.append(UpdateOne({"tenant_id": tenant_id, "plex_id": plex_id}, {"$set": changed}))
+
+    for plex_id in previous:
+        if plex_id not in seen:
+            ops.append(DeleteOne({"tenant_id": tenant_id, "plex_id": plex_id}))
+    return ops
+
+
+def save_watchlist(collection, new_items, previous, tenant_id):
+    """Applies only the changes between ``previous`` and ``new_items`` in one unordered bulk write.
+
+    Returns the number of operations sent.
+    """
+    ensure_indexes(collection)
+    ops = build_operations(new_items, previous, tenant_id)
+    if ops:
+        result = collection.bulk_write(ops, ordered=False)
+        logger.info(
+            f"Watchlist guardada: {result.upserted_count} nuevos, "
+            f"{result.modified_count} modificados, {result.deleted_count} eliminados"
+        )
+    return len(ops)
+
+
+def encode_cursor(value, plex_id):
+    raw = json.dumps([value, plex_id]).encode()
+    return base64.urlsafe_b64encode(raw).decode()
+
+
+def decode_cursor(cursor):
+    value, plex_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    return value, plex_id
+
+
+def _after(field, direction, value, plex_id):
+    """Keyset condition for the documents that follow ``(value, plex_id)``.
+
+    ``plex_id`` breaks ties in the same ``direction`` as ``field``. Mongo
+    sorts nulls first, so they come before any value ascending and after
+    every value descending.
+    """
+    tie = {field: value, "plex_id": {"$gt" if direction == ASCENDING else "$lt": plex_id}}
+    if value is None:
+        if direction == ASCENDING:
+            return {"$or": [tie, {field: {"$ne": None}}]}
+        return tie
+    if direction == ASCENDING:
+        return {"$or": [{field: {"$gt": value}}, tie]}
+    return {"$or": [{field: {"$lt": value}}, {field: None}, tie]}
+
+
+def build_filter(tenant_id, status="all", type_="all", owner="all"):
+    query = {"tenant_id": tenant_id}
+    if status == "online":
+        query["on_server"] = True
+    elif status == "offline":
+        query["on_server"] = {"$ne": True}
+    elif status == "recent":
+        query["on_server"] = True
+        query["added_at"] = {"$gte": int(time.time()) - RECENT_SECONDS}
+    if type_ and type_ != "all":
+        query["type"] = type_
+    if owner and owner != "all":
+        query["owners"] = owner
+    return query
+
+
+def query_watchlist(collection, tenant_id, status="all", type_="all", owner="all", sort="watchlist_newest",
+                    cursor=None, limit=50, fields=None):
+    """Returns one page of the filtered, sorted watchlist of ``tenant_id``.
+
+    The result is ``{"items", "next_cursor"}``; the first page (no cursor)
+    also carries ``total`` and ``available`` counts for the whole filter.
+    Raises ``ValueError`` on an unknown sort or a malformed cursor.
+    """
+    if sort not in SORTS:
+        raise ValueError(f"Orden desconocido: {sort}")
+    field, direction = SORTS[sort]
+    limit = max(1, min(int(limit), MAX_PAGE_SIZE))
+
+    query = build_filter(tenant_id, status, type_, owner)
+    filtered = dict(query)
+    if cursor:
+        try:
+            value, last_id = decode_cursor(cursor)
+        except Exception:
+            raise ValueError("Cursor inválido")
+        query = {"$and": [query, _after(field, direction, value, last_id)]}
+
+    wanted = [f for f in (fields or PUBLIC_FIELDS) if f in PUBLIC_FIELDS]
+    projection = {f: 1 for f in wanted + ["plex_id", field]}
+    projection["_id"] = 0
+
+    options = {"collation": TITLE_COLLATION} if field == "title" else {}
+    docs = list(
+        collection.find(query, projection, **options)
+        .sort([(field, direction), ("plex_id", direction)])
+        .limit(limit + 1)
+    )
+
+    page = {"items": docs[:limit], "next_cursor": None}
+    if len(docs) > limit:
+        last = docs[limit - 1]
+        page["next_cursor"] = encode_cursor(last.get(field), last["plex_id"])
+    if not cursor:
+        page["total"] = collection.count_documents(filtered)
+        if filtered.get("on_server") == {"$ne": True}:
+            page["available"] = 0
+        else:
+            page["available"] = collection.count_documents(dict(filtered, on_server=True))
+    return page
@@ -0,0 +1,83 @@
+"""Sync worker: hourly syncs of every tenant, the syncs requested from the web and Telegram announcements.
+
+Usage (from the repository root):
+
+    python worker.py                    # long-running process (Procfile ``worker``)
+    python worker.py --once             # one sync of every tenant, then exit
+    python worker.py --once --tenant casa
+
+The web process (``app.py``) never syncs by itself: ``/api/sync`` leaves a
+request on the tenant's lease and this process picks it up within
+``WORKER_POLL_SECONDS``. With ``EMBEDDED_WORKER=true`` the web starts this
+same worker in a background thread instead (single-process deployments).
+"""
+import time
+import logging
+import argparse
+import threading
+from datetime import datetime, timedelta
+from apscheduler.schedulers.background import BackgroundScheduler
+from config import TENANTS, TENANTS_BY_ID, WORKER_POLL_SECONDS
+from tenants import schedule_offsets, adopt_legacy_data
+
+logger = logging.getLogger(__name__)
+
+
+def start():
+    """Starts the scheduler in background threads and returns it."""
+    import sync
+
+    # Los datos de antes de los tenants pasan al primero
+    adopt_legacy_data(sync.db, TENANTS[0].id)
+
+    scheduler = BackgroundScheduler()
+    # Cada tenant sincroniza cada hora en su propio minuto para repartir la carga
+    now = datetime.now()
+    for tenant_id, offset in schedule_offsets(TENANTS).items():
+        first_run = now.replace(minute=0, second=0, microsecond=0) + timedelta(minutes=offset)
+        if first_run <= now:
+            first_run += timedelta(hours=1)
+        scheduler.add_job(func=sync.scheduled_sync, args=[tenant_id], trigger="interval", hours=1, next_run_time=first_run)
+    # Sincronizaciones pedidas desde la web
+    scheduler.add_job(func=sync.poll_requests, trigger="interval", seconds=WORKER_POLL_SECONDS)
+    # Reintentos de avisos de Telegram que fallaron o quedaron limitados
+    scheduler.add_job(func=sync.dispatch_telegram, trigger="interval", minutes=1)
+    scheduler.start()
+    logger.info(f"Worker de sincronización en marcha para {len(TENANTS)} tenant(s)")
+    return scheduler
+
+
+def run_once(tenant_ids):
+    """Syncs ``tenant_ids`` now (through their leases) and waits for them to finish."""
+    import sync
+
+    adopt_legacy_data(sync.db, TENANTS[0].id)
+    for tenant_id in tenant_ids:
+        run_id, state = sync.sync_coordinators[tenant_id].trigger()
+        logger.info(f"Sincronización de {tenant_id}: {state} ({run_id})")
+    for thread in threading.enumerate():
+        if thread.name.startswith("sync-"):
+            thread.join()
+    sync.dispatch_telegram()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--once", action="store_true", help="sync now and exit instead of running the scheduler")
+    parser.add_argument("--tenant", action="append", choices=sorted(TENANTS_BY_ID), help="only this tenant (repeatable)")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    if args.once:
+        return run_once(args.tenant or [t.id for t in TENANTS])
+
+    scheduler = start()
+    try:
+        while True:
+            time.sleep(3600)
+    except (KeyboardInterrupt, SystemExit):
+        scheduler.shutdown(wait=False)
+
+
+if __name__ == "__main__":
+    main()